@@ -0,0 +1,165 @@
+from tester import green, red
+import argparse
+import glob
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak memory is not measured there
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GENERATOR = os.path.join(HERE, "generator.py")
+CATALOG = os.path.join(HERE, "bench", "*.format")
+BASELINE = os.path.join(HERE, "bench", "baseline." + platform.system() + ".json")
+
+# a format without any print, so that a run only loads the interpreter,
+# the modules and the bootstrap rules
+EMPTY_FORMAT = "nothing = \"\"\n"
+
+
+def with_rows(source, rows):
+    # every print of the format generates the given number of rows
+    return re.sub(r"print\s*\(\s*\d+", "print(%d" % rows, source)
+
+
+def run_once(format_file, processes, output):
+    # returns the wall time, and the peak resident memory in KiB of
+    # the largest process of the run
+    command = [sys.executable, GENERATOR, "-s", "1", "-p", str(processes),
+               format_file, output]
+    start = time.perf_counter()
+    p = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    if resource != None and hasattr(os, "wait4"):
+        _, status, usage = os.wait4(p.pid, 0)
+        p.returncode = os.waitstatus_to_exitcode(status)
+        rss = usage.ru_maxrss
+        if platform.system() == "Darwin":
+            # reported in bytes there
+            rss //= 1024
+    else:
+        p.wait()
+        rss = 0
+    wall = time.perf_counter() - start
+    if p.returncode != 0:
+        raise RuntimeError("'%s' failed with code %d!"
+                           % (" ".join(command), p.returncode))
+    return (wall, rss)
+
+
+def best_of(repeat, format_file, processes, output):
+    # the fastest run, and the largest memory of all of them
+    runs = [run_once(format_file, processes, output) for _ in range(repeat)]
+    return (min([r[0] for r in runs]), max([r[1] for r in runs]))
+
+
+def run_all(formats, row_counts, process_counts, repeat, workdir):
+    res = {}
+    output = os.path.join(workdir, "output.txt")
+    empty = os.path.join(workdir, "empty.format")
+    with open(empty, "w") as f:
+        f.write(EMPTY_FORMAT)
+    startup, rss = best_of(repeat, empty, 1, output)
+    res["startup"] = {"seconds": startup, "rss": rss}
+    print("%-36s %8.3fs %10d KiB" % ("startup", startup, rss))
+    for path in formats:
+        with open(path, "r") as f:
+            source = f.read()
+        prints = len(re.findall(r"print\s*\(\s*\d+", source))
+        name = os.path.splitext(os.path.basename(path))[0]
+        for rows in row_counts:
+            scaled = os.path.join(workdir, "%s.%d.format" % (name, rows))
+            with open(scaled, "w") as f:
+                f.write(with_rows(source, rows))
+            for processes in process_counts:
+                wall, rss = best_of(repeat, scaled, processes, output)
+                key = "%s:%d:%d" % (name, rows, processes)
+                res[key] = {"seconds": wall, "rss": rss,
+                            "rows_per_second": rows * prints / wall}
+                print("%-36s %8.3fs %10d KiB %12.0f rows/s"
+                      % (key, wall, rss, res[key]["rows_per_second"]))
+    return res
+
+
+def compare(old, new, threshold):
+    # returns the number of regressions, where a run got slower, or
+    # needed more memory, by more than threshold percent
+    regressions = 0
+    for key in sorted(new):
+        if key not in old:
+            continue
+        checks = [("rss", 1)]
+        if "rows_per_second" in new[key]:
+            checks.append(("rows_per_second", -1))
+        else:
+            checks.append(("seconds", 1))
+        for field, sign in checks:
+            before = old[key].get(field, 0)
+            after = new[key][field]
+            if before <= 0:
+                continue
+            change = (after - before) * 100 / before
+            if change * sign > threshold:
+                regressions += 1
+                print(red("[Regression]") + " %s %s: %.6g -> %.6g (%+.1f%%)"
+                      % (key, field, before, after, change))
+            elif change * sign < -threshold:
+                print(green("[Improved]") + " %s %s: %.6g -> %.6g (%+.1f%%)"
+                      % (key, field, before, after, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="time the generation of the format files in bench/ "
+        "from start to end, and compare it with the baseline")
+    parser.add_argument('formats', nargs='*',
+                        help="format files to run (default is bench/*.format)")
+    parser.add_argument('-r', '--rows', nargs='+', type=int,
+                        default=[10000, 100000],
+                        help="rows generated by each print of the formats")
+    parser.add_argument('-p', '--processes', nargs='+', type=int,
+                        default=[1, 2, 4],
+                        help="numbers of processes to run the formats with")
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help="runs of each case, the fastest one is kept")
+    parser.add_argument('-b', '--baseline', default=BASELINE,
+                        help="file of the results to compare with "
+                        "(default is bench/baseline.<system>.json)")
+    parser.add_argument('-t', '--threshold', type=float, default=10.0,
+                        help="percent of change reported as a regression")
+    parser.add_argument('-s', '--save', action='store_true',
+                        help="store the results as the new baseline")
+    given = parser.parse_args()
+
+    formats = given.formats or sorted(glob.glob(CATALOG))
+    with tempfile.TemporaryDirectory() as workdir:
+        res = run_all(formats, given.rows, given.processes, given.repeat, workdir)
+
+    old = {}
+    try:
+        with open(given.baseline, "r") as f:
+            old = json.load(f)
+    except (OSError, ValueError):
+        print("[Info] No baseline found at '%s'" % given.baseline)
+    regressions = compare(old, res, given.threshold)
+    if given.save or len(old) == 0:
+        with open(given.baseline, "w") as f:
+            json.dump(res, f, indent=1, sort_keys=True)
+        print("[Info] Saved the results to '%s'" % given.baseline)
+    if regressions > 0:
+        print(red("[Error]") + " %d regression(s) above %.1f%%!"
+              % (regressions, given.threshold))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
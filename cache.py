@@ -0,0 +1,51 @@
+import hashlib
+import os
+import pickle
+
+# bump whenever the shape of the cached objects changes
+CACHE_VERSION = 1
+
+
+def cache_dir():
+    return os.environ.get("RANDATA_CACHE",
+                          os.path.join(os.path.expanduser("~"), ".cache", "randata"))
+
+
+def cache_path(kind, data, extension="pickle"):
+    digest = hashlib.sha256(("%d:" % CACHE_VERSION).encode() + data).hexdigest()
+    return os.path.join(cache_dir(), "%s-%s.%s" % (kind, digest, extension))
+
+
+def load(path):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        # missing, unreadable or stale, just rebuild it
+        return None
+
+
+def store(path, obj, dump=None):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = "%s.%d" % (path, os.getpid())
+        with open(temp, "wb") as f:
+            if dump != None:
+                dump(obj, f)
+            else:
+                pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # readers never see a half written file
+        os.replace(temp, path)
+    except OSError:
+        pass
+
+
+def parse_cached(source, parse):
+    # parsed statements of a source, keyed by the hash of its
+    # content, so an unchanged file is never scanned twice
+    path = cache_path("ast", source.encode())
+    statements = load(path)
+    if statements == None:
+        statements = parse(source)
+        store(path, statements)
+    return statements
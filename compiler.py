@@ -0,0 +1,299 @@
+from my_parser import AstVisitor, VariableExpression, LiteralExpression
+from my_parser import AssignmentStatement, FunctionCallExpression, PrintStatement
+from scanner import Token
+from itertools import repeat
+from profiler import StepTimer, TimedColumn, column_bytes, rule_name
+
+# kinds of steps in a plan
+CONSTANT = 0
+CALL = 1
+COLUMNS = 2
+
+
+class CompileError(Exception):
+    pass
+
+
+def literal_value(token):
+    if token.type == Token.INTEGER:
+        return int(token.val)
+    return str(token.val.replace("\"", ""))
+
+
+def find_references(statements):
+    # the (table, column) pairs named by the foreign_key calls of
+    # the statements, so that the prints of those tables keep them
+    res = set()
+    pending = list(statements)
+    while len(pending) > 0:
+        ast = pending.pop()
+        if isinstance(ast, AssignmentStatement):
+            pending.append(ast.rhs)
+        elif isinstance(ast, PrintStatement):
+            pending.append(ast.val)
+        elif isinstance(ast, FunctionCallExpression):
+            if (ast.func.val == "foreign_key" and len(ast.args) == 2
+                    and all(isinstance(a, LiteralExpression) for a in ast.args)):
+                res.add(tuple(literal_value(a.val) for a in ast.args))
+            pending.extend(ast.args)
+    return res
+
+
+class Plan:
+    # A print lowered into a flat list of steps. Each step produces
+    # one column of values, and only refers to the columns of the
+    # steps before it, so evaluating a plan is a single loop over
+    # the steps, without any lookups. Steps only contain plain
+    # values and module level functions, so a plan is cheap to
+    # send to a worker process.
+
+    def __init__(self):
+        self.steps = []
+        self.result = None
+        # columns which are not needed anymore after each step
+        self.release = []
+        # columns read by more than one step
+        self.shared = set()
+
+    def add(self, step):
+        self.steps.append(step)
+        return len(self.steps) - 1
+
+    def finish(self, result):
+        self.result = result
+        last_use = {}
+        uses = {}
+        for i, step in enumerate(self.steps):
+            if step[0] != CONSTANT:
+                for a in step[-2]:
+                    if self.steps[a][0] == COLUMNS and self.steps[a][1] == "record":
+                        raise CompileError("A record can only be printed, not "
+                                           "passed to '%s'!" % step[1])
+                    last_use[a] = i
+                    uses[a] = uses.get(a, 0) + 1
+        self.shared = set(a for a, n in uses.items() if n > 1)
+        # the result is handed over to the caller instead
+        last_use.pop(result, None)
+        self.release = [[] for _ in self.steps]
+        for slot, i in last_use.items():
+            self.release[i].append(slot)
+
+    def unique_pools(self):
+        # returns the candidates of every one_of_unique whose
+        # arguments are constants, and whether those are all of them
+        pools = {}
+        partitionable = True
+        for step in self.steps:
+            if step[0] == CALL and step[1] == "one_of_unique":
+                args = [self.steps[a] for a in step[4]]
+                if all(a[0] == CONSTANT for a in args):
+                    pools[step[5]] = [a[1] for a in args]
+                else:
+                    partitionable = False
+        return (pools, partitionable)
+
+    def unique_ranges(self):
+        # returns the bounds of every number_between_unique, as they
+        # are passed to it
+        ranges = {}
+        for step in self.steps:
+            if step[0] == COLUMNS and step[1] == "number_between_unique":
+                ranges[step[4]] = [(self.steps[a][1], self.steps[a][0] == CONSTANT)
+                                   for a in step[3]]
+        return ranges
+
+    def run(self, times, r, profile=None, first=0, seed=0):
+        # values only live for a single run, i.e. a single batch,
+        # and each of them is dropped right after its last use.
+        # functions may return lazy iterators, which are chained into
+        # the steps reading them, so a column read by a single step is
+        # never built in full. only the shared columns and the result
+        # are turned into lists. when profiling, the lazy columns are
+        # timed as their rows are pulled, as building them any earlier
+        # would change the order of the random draws.
+        # first is the index of the first row of the batch in the print,
+        # and seed is shared by all the batches of the print.
+        batch = (times, r, first, seed)
+        values = []
+        if profile != None:
+            timer = StepTimer()
+            # (rule, function, seconds of the call, column) of each
+            # lazy column, added once the result has pulled them all
+            lazy = []
+        for step, release in zip(self.steps, self.release):
+            if step[0] == CONSTANT:
+                values.append((step[1], True))
+                continue
+            if profile != None:
+                start = timer.enter()
+            if step[0] == COLUMNS:
+                _, name, func, args, key = step
+                res = func([values[a] for a in args], batch, key)
+            else:
+                _, name, func, vector_func, args, key = step
+                args = [values[a] for a in args]
+                if all(a[1] for a in args):
+                    res = vector_func([a[0] for a in args], batch, key)
+                else:
+                    res = func(zip(*[repeat(a[0], times) if a[1] else a[0]
+                                     for a in args]), r, repeat(key))
+            if profile != None:
+                seconds = timer.leave(start)
+                if res[1]:
+                    # constants are not timed
+                    pass
+                elif hasattr(res[0], "__len__"):
+                    profile.add(rule_name(step[-1]), name, seconds,
+                                len(res[0]), column_bytes(res[0]))
+                else:
+                    res = (TimedColumn(res[0], timer), False)
+                    lazy.append((rule_name(step[-1]), name, seconds, res[0]))
+            if res[1]:
+                # keep only the raw value of a constant
+                values.append((next(iter(res[0])), True))
+            elif len(values) in self.shared and not hasattr(res[0], "__len__"):
+                values.append((list(res[0]), False))
+            else:
+                values.append(res)
+            for slot in release:
+                values[slot] = None
+        res = values[self.result]
+        if res[1]:
+            res = [res[0]] * times
+        elif not hasattr(res[0], "__len__"):
+            res = list(res[0])
+        else:
+            res = res[0]
+        if profile != None:
+            for rule, name, seconds, column in lazy:
+                profile.add(rule, name, seconds + column.seconds,
+                            column.rows, column.size)
+        return res
+
+
+class Compiler(AstVisitor):
+
+    def __init__(self, grammars, defaultrules, function_dictionary,
+                 vector_function_dictionary, column_function_dictionary,
+                 argcount, pure_functions=(), keys={}):
+        AstVisitor.__init__(self, debug=False)
+        self.grammars = grammars
+        self.defaultrules = defaultrules
+        self.function_dictionary = function_dictionary
+        self.vector_function_dictionary = vector_function_dictionary
+        self.column_function_dictionary = column_function_dictionary
+        self.argcount = argcount
+        # functions which neither draw random values nor keep any
+        # state, so their calls can be evaluated once and shared
+        self.pure_functions = pure_functions
+        # the columns of the tables printed so far which foreign_key
+        # can draw from, as (table, column) -> reference
+        self.keys = keys
+
+    def compile(self, ast):
+        # ast is either a print, or a bare expression
+        plan = Plan()
+        # slot of each rule already lowered into this plan, so that
+        # all uses of a rule share the same column
+        self.slots = {}
+        # slot of each constant and pure call already in this plan,
+        # so that repeating them, in any rule, costs nothing extra
+        self.numbered = {}
+        self.compiling = set()
+        self.rule = "print"
+        plan.finish(self.visit_optional(ast, plan))
+        return plan
+
+    def visit_assignment(self, ast, plan):
+        raise CompileError("Assignments cannot be compiled!")
+
+    def visit_print(self, ast, plan):
+        return self.visit_optional(ast.val, plan)
+
+    def constant(self, plan, value):
+        try:
+            signature = (CONSTANT, type(value), value)
+            hash(signature)
+        except TypeError:
+            return plan.add((CONSTANT, value))
+        if signature not in self.numbered:
+            self.numbered[signature] = plan.add((CONSTANT, value))
+        return self.numbered[signature]
+
+    def visit_literal(self, ast, plan):
+        return self.constant(plan, literal_value(ast.val))
+
+    def visit_variable(self, ast, plan):
+        name = ast.val.val
+        if name in self.slots:
+            return self.slots[name]
+        elif name in self.grammars:
+            if name in self.compiling:
+                raise CompileError("Rule '%s' refers to itself!" % name)
+            self.compiling.add(name)
+            outer = self.rule
+            self.rule = name
+            slot = self.visit_optional(self.grammars[name], plan)
+            self.rule = outer
+            self.compiling.remove(name)
+            self.slots[name] = slot
+            return slot
+        elif name in self.defaultrules:
+            return self.constant(plan, self.defaultrules[name])
+        else:
+            raise CompileError("No such rule found '%s'!" % name)
+
+    def visit_function_call(self, ast, plan):
+        name = ast.func.val
+        if (name not in self.function_dictionary
+                and name not in self.column_function_dictionary):
+            raise CompileError("Invalid function name '%s'!" % (ast.func))
+        argc = self.argcount[name]
+        if argc != -1 and len(ast.args) != argc:
+            raise CompileError("Function '%s' takes %d arguments, %d given!"
+                               % (name, argc, len(ast.args)))
+        args = tuple(self.visit_optional(arg, plan) for arg in ast.args)
+        if name in self.pure_functions:
+            if all(plan.steps[a][0] == CONSTANT for a in args):
+                # fold it into a constant right away
+                res = self.vector_function_dictionary[name](
+                    [plan.steps[a][1] for a in args], (1, None), None)
+                if res[1]:
+                    return self.constant(plan, next(iter(res[0])))
+            signature = (name, args)
+            if signature in self.numbered:
+                return self.numbered[signature]
+            self.numbered[signature] = self.add_call(plan, name, args)
+            return self.numbered[signature]
+        return self.add_call(plan, name, args, ast.args)
+
+    def add_call(self, plan, name, args, arg_asts=()):
+        # the key tells apart the states kept by different calls,
+        # like the values already drawn by a one_of_unique
+        key = "%s#%d" % (self.rule, len(plan.steps))
+        if name == "record":
+            # a record instead keeps the names of its columns, taken
+            # from the rules, and the name of its own rule
+            columns = tuple(arg.val.val if isinstance(arg, VariableExpression)
+                            else "column%d" % (i + 1)
+                            for i, arg in enumerate(arg_asts))
+            repeated = [c for i, c in enumerate(columns) if c in columns[:i]]
+            if len(repeated) > 0:
+                raise CompileError("Column '%s' appears more than once in "
+                                   "the record!" % repeated[0])
+            key = (columns, self.rule if self.rule != "print" else None)
+        elif name == "foreign_key":
+            # the column to draw from is resolved right away, so the
+            # plan carries all a worker needs to open it
+            if not all(isinstance(arg, LiteralExpression) for arg in arg_asts):
+                raise CompileError("Arguments of foreign_key must be literals!")
+            table, column = [str(literal_value(arg.val)) for arg in arg_asts]
+            if (table, column) not in self.keys:
+                raise CompileError("No column '%s' of table '%s' was printed "
+                                   "before this foreign_key!" % (column, table))
+            key = (self.keys[(table, column)], self.rule)
+        if name in self.column_function_dictionary:
+            return plan.add((COLUMNS, name, self.column_function_dictionary[name],
+                             args, key))
+        return plan.add((CALL, name, self.function_dictionary[name],
+                         self.vector_function_dictionary[name], args, key))
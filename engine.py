@@ -1,107 +1,513 @@
-from my_parser import AstVisitor, FunctionCallExpression, PrintStatement, VariableExpression
-from scanner import Token
+from my_parser import AstVisitor, VariableExpression
+from compiler import Compiler, COLUMNS, find_references
+from output import BUFFER_SIZE, OutputFormat, Records, Shard, write_lines
+from linefile import open_line_file
+from keycolumn import KeyColumn, column_values, open_key_column
+from profiler import Profile
 import random
+import hashlib
+import os
+import threading
+import pickle
+import sys
+import time
 from itertools import repeat, chain
 from contextlib import nullcontext
+from functools import lru_cache
+import importlib.util
+
+# numpy takes longer to import than a small print takes to run, so it
+# is only imported by the first column long enough to be drawn with it
+numpy = None
+
+# below this many values, the setup cost of numpy outweighs its speed
+NUMPY_MIN_ROWS = 256
+
+# rows evaluated to estimate the cost of a print
+PILOT_ROWS = 256
+# rough cost of starting one worker process, in seconds
+PROCESS_STARTUP = 0.05
+# a pool is only used if it is estimated to take at most this
+# fraction of the time of evaluating in a single thread
+PARALLEL_MARGIN = 0.8
+
+# bumped whenever the checkpoints written by Engine.checkpoint change
+CHECKPOINT_VERSION = 1
+
+
+@lru_cache(maxsize=None)
+def numpy_installed():
+    # without importing it
+    try:
+        return importlib.util.find_spec("numpy") != None
+    except (ImportError, ValueError):
+        return False
+
+
+def use_numpy(rows):
+    # whether a column of this many rows is drawn with numpy
+    global numpy
+    if rows < NUMPY_MIN_ROWS or not numpy_installed():
+        return False
+    if numpy == None:
+        import numpy
+    return True
+
+
+def numpy_generator(r):
+    # derive a numpy generator from the Random object of the batch,
+    # so that both backends draw from the same stream
+    return numpy.random.default_rng(r.getrandbits(64))
+
 
 def append(y, r, rule=None):
-    return ([''.join([str(z) for z in x]) for x in y], False)
+    return ((''.join([str(z) for z in x]) for x in y), False)
 
 
 def append_times(x, y, rule=None):
     # unpack the raw value, and mark the
     # returning one as constant
-    return (repeat(append(x, y[1])[0][0], y[0]), True)
+    return (repeat(next(append([x], y[1])[0]), y[0]), True)
+
+
+def append_columns(x, y, rule=None):
+    # x is a list of (column, is_constant) pairs. neighbouring
+    # constants are merged into the format string beforehand, so
+    # each row costs a single formatting of the variable columns.
+    if all(c[1] for c in x):
+        return append_times([c[0] for c in x], y)
+    fmt = []
+    columns = []
+    for c in x:
+        if c[1]:
+            fmt.append(str(c[0]).replace("%", "%%"))
+        else:
+            fmt.append("%s")
+            columns.append(c[0])
+    return (map(''.join(fmt).__mod__, zip(*columns)), False)
 
 
 def one_of(l, r, rule=None):
-    return ([r.choice(k) for k in l], False)
+    if numpy_installed():
+        rows = list(l)
+        if use_numpy(len(rows)):
+            choices = numpy.array(rows, dtype=object)
+            picked = numpy_generator(r).integers(0, choices.shape[1],
+                                                 size=len(rows))
+            return (choices[numpy.arange(len(rows)), picked], False)
+        l = rows
+    return ((r.choice(k) for k in l), False)
 
 
 def one_of_times(l, y, rule=None):
+    if use_numpy(y[0]):
+        picked = numpy_generator(y[1]).integers(0, len(l), size=y[0])
+        return (numpy.array(l, dtype=object)[picked], False)
     return (y[1].choices(l, k=y[0]), False)
 
 
+@lru_cache(maxsize=1024)
+def alias_table(pairs):
+    # Vose's alias method: split the weights into k columns of equal
+    # height, each holding at most two values, so that a draw is a
+    # random column and a single comparison
+    values = pairs[0::2]
+    try:
+        weights = [float(w) for w in pairs[1::2]]
+    except ValueError:
+        raise EngineError("Weights of one_of_weighted must be numbers!")
+    total = sum(weights)
+    if len(values) == 0 or len(values) != len(weights):
+        raise EngineError("one_of_weighted takes pairs of value and weight!")
+    if total <= 0 or any(w < 0 for w in weights):
+        raise EngineError("Weights of one_of_weighted must be positive!")
+    k = len(values)
+    prob = [w * k / total for w in weights]
+    alias = list(range(k))
+    small = [i for i, p in enumerate(prob) if p < 1.0]
+    large = [i for i, p in enumerate(prob) if p >= 1.0]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        alias[s] = l
+        prob[l] -= 1.0 - prob[s]
+        if prob[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+    # whatever is left is full up to rounding errors
+    for i in small + large:
+        prob[i] = 1.0
+    return (values, prob, alias)
+
+
+def weighted_draws(table, times, r):
+    values, prob, alias = table
+    k = len(values)
+    if use_numpy(times):
+        x = numpy_generator(r).random(times) * k
+        column = x.astype(numpy.int64)
+        picked = numpy.where(x - column < numpy.array(prob)[column],
+                             column, numpy.array(alias)[column])
+        return numpy.array(values, dtype=object)[picked]
+    res = []
+    for _ in range(times):
+        # the integer part picks the column, and the
+        # fraction decides between its two values
+        x = r.random() * k
+        column = int(x)
+        res.append(values[column] if x - column < prob[column]
+                   else values[alias[column]])
+    return res
+
+
+def one_of_weighted(l, r, rule=None):
+    return ((weighted_draws(alias_table(tuple(x)), 1, r)[0] for x in l), False)
+
+
+def one_of_weighted_times(x, y, rule=None):
+    # the table is built once, and then found in the cache
+    # for every following batch of the same rule
+    return (weighted_draws(alias_table(tuple(x)), y[0], y[1]), False)
+
+
+def record_columns(x, y, rule):
+    # rule is (names of the columns, name of the table)
+    columns = [repeat(c[0], y[0]) if c[1] else c[0] for c in x]
+    return (Records(zip(*columns), rule[0], rule[1]), False)
+
+
+def sequence_columns(x, y, rule=None):
+    # x is (start, step), and y is (rows, r, index of the first row).
+    # the values only depend on the index of each row in the print, so
+    # every batch computes its own part without knowing the others.
+    first = y[2]
+    try:
+        if all(c[1] for c in x):
+            start = int(x[0][0])
+            step = int(x[1][0])
+            if step == 0:
+                return (repeat(start, y[0]), True)
+            # a range is a lazy, but complete, column
+            return (range(start + step * first, start + step * (first + y[0]),
+                          step), False)
+        start, step = [repeat(c[0], y[0]) if c[1] else c[0] for c in x]
+        return ([int(s) + int(t) * i for s, t, i
+                 in zip(start, step, range(first, first + y[0]))], False)
+    except ValueError:
+        raise EngineError("Arguments of sequence must be integers!")
+
+
+# rounds of the Feistel network of number_between_unique
+FEISTEL_ROUNDS = 4
+FEISTEL_MULTIPLIER = 0x9E3779B97F4A7C15
+MASK64 = (1 << 64) - 1
+
+
+@lru_cache(maxsize=1024)
+def feistel_keys(seed, rule):
+    # round keys of a call, the same in every batch of a print
+    digest = hashlib.sha256(("%d:%s" % (seed, rule)).encode()).digest()
+    return tuple(int.from_bytes(digest[8 * i:8 * i + 8], "big")
+                 for i in range(FEISTEL_ROUNDS))
+
+
+def feistel(index, half, keys):
+    # a bijection over [0, 4**half), made of the rounds of a
+    # Feistel network, which is a bijection whatever the rounds do
+    mask = (1 << half) - 1
+    left = index >> half
+    right = index & mask
+    for k in keys:
+        v = ((right ^ k) * FEISTEL_MULTIPLIER) & MASK64
+        left, right = right, left ^ ((v ^ (v >> 32)) & mask)
+    return (left << half) | right
+
+
+def feistel_array(index, half, keys):
+    # the same as feistel, on a numpy array of uint64
+    u = numpy.uint64
+    mask = u((1 << half) - 1)
+    left = index >> u(half)
+    right = index & mask
+    for k in keys:
+        v = (right ^ u(k)) * u(FEISTEL_MULTIPLIER)
+        left, right = right, left ^ ((v ^ (v >> u(32))) & mask)
+    return (left << u(half)) | right
+
+
+def unique_range(x):
+    # returns the bounds of a number_between_unique, and the number
+    # of values between them
+    if not all(c[1] for c in x):
+        raise EngineError("Bounds of number_between_unique must be constants!")
+    try:
+        lower = int(x[0][0])
+        upper = int(x[1][0])
+    except ValueError:
+        raise EngineError("Bounds of number_between_unique must be integers!")
+    size = upper - lower + 1
+    if size <= 0 or size > 1 << 64:
+        raise EngineError("Invalid range (%d, %d) of number_between_unique!"
+                          % (lower, upper))
+    return (lower, upper, size)
+
+
+def number_between_unique_columns(x, y, rule):
+    # the i-th row of the print gets the i-th value of a keyed
+    # permutation of [lower, upper], so the values never repeat in a
+    # print, and each batch computes its own without keeping any of
+    # the others. the permutation covers the smallest power of four
+    # holding the range, and the values beyond the range are walked
+    # along their cycle until they fall inside it.
+    lower, upper, size = unique_range(x)
+    times, _, first, seed = y
+    if first + times > size:
+        raise EngineError(
+            "Required %d unique values cannot be generated!" % (first + times))
+    half = max(1, ((size - 1).bit_length() + 1) // 2)
+    keys = feistel_keys(seed, rule)
+    if use_numpy(times):
+        res = feistel_array(numpy.arange(first, first + times, dtype=numpy.uint64),
+                            half, keys)
+        # size itself does not fit in a uint64 when the range is 2**64
+        outside = res > numpy.uint64(size - 1)
+        while outside.any():
+            res[outside] = feistel_array(res[outside], half, keys)
+            outside = res > numpy.uint64(size - 1)
+        if -(1 << 63) <= lower and upper < 1 << 63:
+            # added modulo 2**64, which is right as long as the sum
+            # fits in an int64, even when the offset does not
+            res += numpy.uint64(lower & MASK64)
+            return (res.view(numpy.int64), False)
+        return ([lower + v for v in res.tolist()], False)
+    res = []
+    for i in range(first, first + times):
+        v = feistel(i, half, keys)
+        while v >= size:
+            v = feistel(v, half, keys)
+        res.append(lower + v)
+    return (res, False)
+
+
+def foreign_key_columns(x, y, rule):
+    # rule is (reference of the column, rule), the arguments only name it
+    keys = open_key_column(rule[0])
+    if keys.count == 0:
+        raise EngineError("No keys to draw from!")
+    if use_numpy(y[0]):
+        picked = numpy_generator(y[1]).integers(0, keys.count, size=y[0]).tolist()
+    else:
+        picked = y[1].choices(range(keys.count), k=y[0])
+    return (keys.lines(picked), False)
+
+
+def row_number_columns(x, y, rule=None):
+    # counts the rows of a print from 1
+    return (range(y[2] + 1, y[2] + y[0] + 1), False)
+
+
+def line_file(path):
+    try:
+        return open_line_file(str(path))
+    except OSError as e:
+        raise EngineError("Unable to read '%s': %s" % (path, e))
+
+
+def one_of_file(l, r, rule=None):
+    def draws():
+        for x in l:
+            f = line_file(x[0])
+            yield f.line(r.randrange(f.count))
+    return (draws(), False)
+
+
+def one_of_file_times(x, y, rule=None):
+    f = line_file(x[0])
+    if use_numpy(y[0]):
+        picked = numpy_generator(y[1]).integers(0, f.count, size=y[0]).tolist()
+    else:
+        picked = y[1].choices(range(f.count), k=y[0])
+    return (f.lines(picked), False)
+
+
 def lower(w, r, rule=None):
-    return ([str(x[0]).lower() for x in w], False)
+    return ((str(x[0]).lower() for x in w), False)
 
 
 def lower_times(x, y, rule=None):
     return (repeat(str(x[0]).lower(), y[0]), True)
 
 
-def one_of_unique(k, r, rules):
-    global UNIQUE_DICTIONARY
-    global UNIQUE_DICTIONARY_LOCK
+def unique_pool(l, r):
+    # drop the duplicates, and shuffle once, so that
+    # a unique draw is just a pop from the end
+    pool = list(dict.fromkeys(l))
+    r.shuffle(pool)
+    return pool
 
-    res = []
-    for expand in zip(k, rules):
-        l = expand[0]
-        rule = expand[1]
-        with UNIQUE_DICTIONARY_LOCK:
-            if rule not in UNIQUE_DICTIONARY:
-                UNIQUE_DICTIONARY[rule] = set(l)
-
-            dictionary = UNIQUE_DICTIONARY[rule]
-            if len(dictionary) == 0:
-                raise EngineError("No more unique values to generate!")
-
-            # Value() marks this copy of the value as not constant
-            v = r.sample(dictionary, 1)
-            dictionary.remove(v[0])
-            res.append(v[0])
-            UNIQUE_DICTIONARY[rule] = dictionary
-    return (res, False)
+
+def one_of_unique(k, r, rules):
+    UNIQUE_DICTIONARY = UNIQUE.dictionary
+    UNIQUE_DICTIONARY_LOCK = UNIQUE.lock
+    UNIQUE_POOLS = UNIQUE.pools
+
+    def draws():
+        for expand in zip(k, rules):
+            l = expand[0]
+            rule = expand[1]
+            if rule in UNIQUE_POOLS:
+                # pre-partitioned by the parent, no locking required
+                pool = UNIQUE_POOLS[rule]
+                if len(pool) == 0:
+                    raise EngineError("No more unique values to generate!")
+                yield pool.pop()
+                continue
+            with UNIQUE_DICTIONARY_LOCK:
+                if rule not in UNIQUE_DICTIONARY:
+                    UNIQUE_DICTIONARY[rule] = unique_pool(l, r)
+
+                dictionary = UNIQUE_DICTIONARY[rule]
+                if len(dictionary) == 0:
+                    raise EngineError("No more unique values to generate!")
+
+                value = dictionary.pop()
+                UNIQUE_DICTIONARY[rule] = dictionary
+            yield value
+    return (draws(), False)
 
 
 def one_of_unique_times(l, number, rule):
-    global UNIQUE_DICTIONARY
-    global UNIQUE_DICTIONARY_LOCK
+    UNIQUE_DICTIONARY = UNIQUE.dictionary
+    UNIQUE_DICTIONARY_LOCK = UNIQUE.lock
+    UNIQUE_POOLS = UNIQUE.pools
+
+    if rule in UNIQUE_POOLS:
+        dictionary = UNIQUE_POOLS[rule]
+        if len(dictionary) < number[0]:
+            raise EngineError(
+                "Required %d unique values cannot be generated!" % number[0])
+        v = dictionary[len(dictionary) - number[0]:]
+        del dictionary[len(dictionary) - number[0]:]
+        return (v, False)
 
     with UNIQUE_DICTIONARY_LOCK:
         if rule not in UNIQUE_DICTIONARY:
-            UNIQUE_DICTIONARY[rule] = set(l)
+            UNIQUE_DICTIONARY[rule] = unique_pool(l, number[1])
 
         dictionary = UNIQUE_DICTIONARY[rule]
         if len(dictionary) < number[0]:
             raise EngineError(
                 "Required %d unique values cannot be generated!" % number[0])
-        v = number[1].sample(dictionary, number[0])
-        dictionary.difference_update(v)
+        v = dictionary[len(dictionary) - number[0]:]
+        del dictionary[len(dictionary) - number[0]:]
 
         UNIQUE_DICTIONARY[rule] = dictionary
     return (v, False)
 
 
+def in_int64(*values):
+    # numpy only draws integers of up to 64 bits
+    return all(-(1 << 63) <= v < (1 << 63) for v in values)
+
+
+def int64_rows(rows):
+    # the rows as a numpy array of int64, or None if some
+    # value does not fit, so that python draws them instead
+    try:
+        return numpy.array(rows, dtype=numpy.int64)
+    except (OverflowError, ValueError, TypeError):
+        return None
+
+
 def between_times(x, y, rule=None):
-    lower = int(x[0])
-    upper = int(x[1])
+    # the bounds may be given in either order
+    lower, upper = sorted((int(x[0]), int(x[1])))
+    if use_numpy(y[0]) and in_int64(lower, upper):
+        return (numpy_generator(y[1]).integers(lower, upper, size=y[0],
+                                                endpoint=True), False)
+    if upper - lower >= sys.maxsize:
+        # too long for choices to take the length of the range
+        return ([lower + y[1].randrange(upper - lower + 1) for _ in range(y[0])],
+                False)
     return (y[1].choices(range(lower, upper + 1), k=y[0]), False)
 
 
 def between(y, r, rule=None):
-    return ([(x[0] + int((x[1] - x[0])*r.random())) for x in y], False)
+    if numpy_installed():
+        rows = list(y)
+        bounds = int64_rows(rows) if use_numpy(len(rows)) else None
+        if bounds is not None:
+            return (numpy_generator(r).integers(
+                numpy.minimum(bounds[:, 0], bounds[:, 1]),
+                numpy.maximum(bounds[:, 0], bounds[:, 1]), endpoint=True), False)
+        y = rows
+    return ((min(x[0], x[1]) + int((abs(x[1] - x[0]) + 1)*r.random()) for x in y),
+            False)
 
 
 def upto_times(x, y, rule=None):
-    upper = int(x[0])
-    return (y[1].choices(range(0, upper + 1), k=y[0]), False)
+    # a negative bound draws from [bound, 0]
+    lower, upper = sorted((0, int(x[0])))
+    if use_numpy(y[0]) and in_int64(lower, upper):
+        return (numpy_generator(y[1]).integers(lower, upper, size=y[0],
+                                                endpoint=True), False)
+    if upper - lower >= sys.maxsize:
+        return ([lower + y[1].randrange(upper - lower + 1) for _ in range(y[0])],
+                False)
+    return (y[1].choices(range(lower, upper + 1), k=y[0]), False)
 
 
 def upto(y, r, rule=None):
-    return ([int(r.random() * (x + 1)) for x in y], False)
+    if numpy_installed():
+        rows = list(y)
+        bounds = int64_rows(rows) if use_numpy(len(rows)) else None
+        if bounds is not None:
+            return (numpy_generator(r).integers(numpy.minimum(bounds[:, 0], 0),
+                                                numpy.maximum(bounds[:, 0], 0),
+                                                endpoint=True), False)
+        y = rows
+    return ((min(x[0], 0) + int(r.random() * (abs(x[0]) + 1)) for x in y), False)
 
 
 class EngineError(Exception):
     pass
 
 
-def init_child(u, l):
-    global UNIQUE_DICTIONARY
-    global UNIQUE_DICTIONARY_LOCK
+# the state of one_of_unique, separate for each thread, as a
+# print may be evaluated by a pool of threads as well
+UNIQUE = threading.local()
 
-    UNIQUE_DICTIONARY = u
-    UNIQUE_DICTIONARY_LOCK = l
+
+def init_child(u, l, p=None):
+    UNIQUE.dictionary = u
+    UNIQUE.lock = l
+    UNIQUE.pools = p if p != None else {}
+
+
+def partition_pools(pools, work_times, r, remaining={}):
+    # shuffle each pool once, and cut it into disjoint slices,
+    # one for each chunk of work, sized to the share of the chunk.
+    # remaining holds the pools left over by an earlier run, which
+    # are already shuffled.
+    total = sum(work_times)
+    parts = [{} for _ in work_times]
+    for rule, l in pools.items():
+        if rule in remaining:
+            pool = list(remaining[rule])
+        else:
+            pool = unique_pool(l, r)
+        if len(pool) < total:
+            raise EngineError(
+                "Required %d unique values cannot be generated!" % total)
+        start = 0
+        done = 0
+        for part, work in zip(parts, work_times):
+            done += work
+            end = (len(pool) * done) // total
+            part[rule] = pool[start:end]
+            start = end
+    return parts
 
 
 class NullManager:
@@ -110,25 +516,175 @@ class NullManager:
         return nullcontext()
 
 
+def set_unique_pools(p):
+    UNIQUE.pools = p
+
+
+def stream_seed(seed, print_no, label):
+    # the seed of an independent stream of random numbers, depending
+    # only on the seed of the run, the print and the label, e.g. the
+    # index of a batch. so the same batch sees the same numbers no
+    # matter which process evaluates it.
+    digest = hashlib.sha256(("%d:%d:%s" % (seed, print_no, label)).encode()).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def run_plan(plan, task, pools=None, profile=None):
+    # task is (rows, seed of the batch, index of its first row,
+    # seed of the print)
+    if pools != None:
+        # the slice of the unique values reserved for this batch
+        set_unique_pools(pools)
+    return plan.run(task[0], random.Random(task[1]), profile, task[2], task[3])
+
+
+def split_batches(times, batch_size):
+    # cut 'times' into consecutive batches of at most batch_size rows
+    full, extra = divmod(times, batch_size)
+    batches = [batch_size] * full
+    if extra > 0:
+        batches.append(extra)
+    return batches
+
+
+def write_shard(res, path, fmt, profile=None, retain=()):
+    # returns the Shard of the batch, with the columns in retain
+    start = time.perf_counter()
+    with open(path, "wb", buffering=BUFFER_SIZE) as h:
+        write_lines(h, res, fmt)
+    if profile != None:
+        profile.add("output", "(write shard)", time.perf_counter() - start,
+                    len(res), os.path.getsize(path))
+    keys = dict([(c, column_values(res, c)) for c in retain])
+    return Shard(path, len(res), getattr(res, "columns", None),
+                 getattr(res, "table", None), keys)
+
+
+def run_task(plan, task, pools, shared, path=None, fmt=OutputFormat(),
+             profiling=False, retain=()):
+    # runs inside a worker. shared is the dictionary and the lock of
+    # the unique values which could not be handed out beforehand.
+    # when profiling, the counters of the batch are sent back along
+    # with it, as (result, profile). retain are the columns kept for
+    # foreign keys, sent back along with a shard.
+    if shared != None:
+        init_child(shared[0], shared[1], pools)
+    else:
+        init_child({}, nullcontext(), pools)
+    profile = Profile() if profiling else None
+    res = run_plan(plan, task, None, profile)
+    if path != None:
+        # write the batch to its own file, and only send the path back
+        res = write_shard(res, path, fmt, profile, retain)
+    if profile != None:
+        return (res, profile)
+    return res
+
+
 class Engine(AstVisitor):
 
-    def __init__(self, generate_only=False, processes=-1):
+    def __init__(self, generate_only=False, processes=-1, batch_size=10000,
+                 shard_prefix=None, seed=None, verbose=False,
+                 output_format=OutputFormat(), profile=None, keep_shards=False):
         AstVisitor.__init__(self, debug=False)
         self.defaultrules = {}
         self.grammars = {}
         self.num_process = processes
+        self.batch_size = batch_size
+        # when set, parallel prints are written by the workers
+        # themselves to files starting with this prefix
+        self.shard_prefix = shard_prefix
+        # the shards are kept as the output, so serial prints are
+        # written to shards as well
+        self.keep_shards = keep_shards and shard_prefix != None
+        self.output_format = output_format
+        self.print_count = 0
+        # every batch draws from its own stream, derived from this seed
+        if seed == None:
+            seed = random.SystemRandom().getrandbits(64)
+        self.seed = seed
+        self.verbose = verbose
+        # for each print, the number of batches already generated and
+        # the unique values left, by an earlier run being resumed, and
+        # by this run so far
+        self.resumed = {}
+        self.state = {}
+        # counters of every evaluated batch, when profiling
+        self.profile = profile
+        # columns named by foreign_key calls, and those kept so far,
+        # as (table, column) -> KeyColumn, in files of key_dir
+        self.references = set()
+        self.key_columns = {}
+        self.key_dir = None
+        # started on the first parallel print, and kept for the rest,
+        # one pool of processes and one of threads at most
+        self.pools = {}
+        self.manager = None
         self.generate_only = generate_only
         self.function_dictionary = {"one_of": one_of, "one_of_unique": one_of_unique,
+                                    "one_of_file": one_of_file,
+                                    "one_of_weighted": one_of_weighted,
                                     "append": append, "lower": lower,
                                     "number_upto": upto, "number_between": between}
         self.vector_function_dictionary = {"one_of": one_of_times, "one_of_unique": one_of_unique_times,
+                                           "one_of_file": one_of_file_times,
+                                           "one_of_weighted": one_of_weighted_times,
                                            "append": append_times, "lower": lower_times,
                                            "number_upto": upto_times,
                                            "number_between": between_times}
-        self.argcount = {"one_of": -1, "one_of_unique": -1,
+        # functions which take their arguments column by column
+        self.column_function_dictionary = {"append": append_columns,
+                                           "record": record_columns,
+                                           "sequence": sequence_columns,
+                                           "foreign_key": foreign_key_columns,
+                                           "number_between_unique":
+                                               number_between_unique_columns,
+                                           "row_number": row_number_columns}
+        self.argcount = {"one_of": -1, "one_of_unique": -1, "one_of_file": 1,
+                         "one_of_weighted": -1, "record": -1,
                          "append": -1, "lower": 1,
-                         "number_upto": 1, "number_between": 2}
-        self.results = {}
+                         "number_upto": 1, "number_between": 2,
+                         "sequence": 2, "row_number": 0,
+                         "number_between_unique": 2, "foreign_key": 2}
+        # functions without randomness or state
+        self.pure_functions = ("append", "lower")
+
+    def compile(self, ast):
+        # resolve the rules, functions and literals reachable
+        # from ast once, instead of on every batch
+        return Compiler(self.grammars, self.defaultrules,
+                        self.function_dictionary,
+                        self.vector_function_dictionary,
+                        self.column_function_dictionary,
+                        self.argcount, self.pure_functions,
+                        dict([(k, c.reference()) for k, c
+                              in self.key_columns.items()])).compile(ast)
+
+    def prepare(self, statements):
+        # find the columns which later prints draw foreign keys from
+        self.references |= find_references(statements)
+
+    def retained_columns(self, plan):
+        # the columns of this print to keep for foreign keys
+        step = plan.steps[plan.result]
+        if step[0] != COLUMNS or step[1] != "record":
+            return (None, ())
+        columns, table = step[-1]
+        return (table, tuple(c for c in columns if (table, c) in self.references))
+
+    def keep_keys(self, res, table, retain):
+        for column in retain:
+            if (table, column) not in self.key_columns:
+                if self.key_dir == None:
+                    import tempfile
+                    self.key_dir = tempfile.mkdtemp(prefix="randata-keys-")
+                path = os.path.join(self.key_dir, "%d.keys" % len(self.key_columns))
+                self.key_columns[(table, column)] = KeyColumn(path)
+            if isinstance(res, Shard):
+                values = res.keys[column]
+            else:
+                values = column_values(res, column)
+            self.key_columns[(table, column)].extend(values)
 
     def visit_assignment(self, ast):
         if isinstance(ast.rhs, VariableExpression):
@@ -141,102 +697,288 @@ class Engine(AstVisitor):
         # return ast.rhs.accept(self)
         # assignment no longer explicitly evaluates
 
-    def evaluate_parallel(self, ast):
-        from multiprocessing import Pool, cpu_count, RLock, Manager
-        workers = self.num_process
-        if workers == -1:
-            workers = cpu_count()
-        times = int(ast.times.val)
-        each_time = int(times / workers)
-        # equally divide work between count - 1 threads
-        work_times = [int(each_time)] * (workers - 1)
-        # dump all the extra work on last thread
-        work_times.append(times - (each_time * (workers - 1)))
-        ast_list = [ast.val] * len(work_times)
-        randomer = [random.Random() for _ in work_times]
-        optional_arg = [(w, r) for w, r in zip(work_times, randomer)]
-        manager = Manager()
-        l = manager.RLock()
-        u = manager.dict()
-        pool = Pool(processes=workers, initializer=init_child, initargs=(u,
-                                                                         l))
-
-        ret = pool.starmap(self.visit_optional, zip(ast_list, optional_arg))
-        pool.close()
-        if not self.generate_only:
-            result = []
-            for y in ret:
-                result.extend(y[0])
-            return result
+    def checkpoint(self):
+        # the state needed to continue this run later, with more rows
+        # of each print, without repeating any stream or unique value
+        prints = dict(self.resumed)
+        prints.update(self.state)
+        return {"version": CHECKPOINT_VERSION, "seed": self.seed,
+                "prints": prints}
+
+    def resume(self, checkpoint):
+        if checkpoint.get("version") != CHECKPOINT_VERSION:
+            raise EngineError("Unsupported checkpoint version '%s'!"
+                              % checkpoint.get("version"))
+        self.seed = checkpoint["seed"]
+        self.resumed = checkpoint["prints"]
+
+    def resumed_unique(self):
+        # the unique values left by an earlier run of this print
+        return self.resumed.get(str(self.print_count), {}).get("unique", {})
+
+    def make_tasks(self, plan, times):
+        # cut the print into batches, and give each of them its stream
+        # and its slice of the unique values. these only depend on the
+        # seed and the batch size, not on the number of processes.
+        # a resumed print continues with the streams after the ones
+        # already used.
+        batches = split_batches(times, self.batch_size)
+        resumed = self.resumed.get(str(self.print_count), {})
+        offset = resumed.get("batches", 0)
+        first = resumed.get("rows", 0)
+        seed = stream_seed(self.seed, self.print_count, "print")
+        tasks = []
+        for i, rows in enumerate(batches):
+            tasks.append((rows, stream_seed(self.seed, self.print_count, offset + i),
+                          first, seed))
+            first += rows
+        # fail before the first batch, instead of after writing the
+        # batches which still fit in a range
+        for bounds in plan.unique_ranges().values():
+            if first > unique_range(bounds)[2]:
+                raise EngineError(
+                    "Required %d unique values cannot be generated!" % first)
+        pools, partitionable = plan.unique_pools()
+        shuffle = random.Random(stream_seed(self.seed, self.print_count, "unique"))
+        parts = partition_pools(pools, batches, shuffle, self.resumed_unique())
+        # every batch takes exactly one value per row from the end of
+        # its slice, so what is left is known beforehand
+        left = {}
+        for rule in pools:
+            left[rule] = [v for part, rows in zip(parts, batches)
+                          for v in part[rule][:len(part[rule]) - rows]]
+        self.state[str(self.print_count)] = {"batches": offset + len(batches),
+                                             "rows": first, "unique": left}
+        return (tasks, parts, partitionable)
+
+    def shared_unique(self, plan):
+        # the resumed unique values of the calls which are not partitioned
+        pools = plan.unique_pools()[0]
+        return dict([(rule, pool) for rule, pool in self.resumed_unique().items()
+                     if rule not in pools])
+
+    def keep_unique(self, dictionary):
+        # save the values left in the shared pools at the end of a print
+        self.state[str(self.print_count)]["unique"].update(dictionary)
+
+    def start_pool(self, mode, workers):
+        if mode not in self.pools:
+            if mode == "thread":
+                from multiprocessing.pool import ThreadPool
+                self.pools[mode] = (ThreadPool(processes=workers), workers)
+            else:
+                from multiprocessing import Pool
+                self.pools[mode] = (Pool(processes=workers), workers)
+        return self.pools[mode]
+
+    def close(self):
+        for pool, _ in self.pools.values():
+            pool.close()
+            pool.join()
+        self.pools = {}
+        if self.manager != None:
+            self.manager.shutdown()
+            self.manager = None
+        if self.key_dir != None:
+            import shutil
+            shutil.rmtree(self.key_dir, ignore_errors=True)
+            self.key_dir = None
+
+    def measure(self, plan, times):
+        # evaluate small pilot batches, with their own stream and unique
+        # values, so that the actual data is not affected. returns the
+        # fixed cost of a batch, the wall time per row, the share of it
+        # spent holding the GIL, and the cost of sending a row back
+        # from a worker.
+        small = min(PILOT_ROWS, times)
+        large = min(4 * PILOT_ROWS, times)
+        samples = []
+        try:
+            # the first run only warms up the caches, like the
+            # alias tables and the files opened by one_of_file
+            for rows in (small, small, large):
+                init_child({}, nullcontext())
+                seed = stream_seed(self.seed, self.print_count, "pilot")
+                task = (rows, seed, 0, seed)
+                wall = time.perf_counter()
+                cpu = time.process_time()
+                res = run_plan(plan, task)
+                samples.append((rows, time.perf_counter() - wall,
+                                time.process_time() - cpu))
+        except EngineError:
+            # the pilot was not representative, like a unique pool
+            # built from the first row, so stay on the safe side
+            return None
+        (_, _, _), (rows1, wall1, cpu1), (rows2, wall2, cpu2) = samples
+        if rows2 > rows1:
+            per_row = max(0.0, (wall2 - wall1) / (rows2 - rows1))
+        else:
+            per_row = wall2 / rows2
+        fixed = max(0.0, wall1 - per_row * rows1)
+        gil = min(1.0, cpu2 / wall2) if wall2 > 0 else 1.0
+        send = time.perf_counter()
+        pickle.loads(pickle.dumps(res, protocol=pickle.HIGHEST_PROTOCOL))
+        send = (time.perf_counter() - send) / rows2
+        return (fixed, per_row, gil, send)
+
+    def choose_execution(self, plan, times):
+        # returns (mode, workers), where mode is one of
+        # "serial", "thread" or "process"
+        if self.num_process == 1:
+            return ("serial", 1)
+        if self.num_process != -1:
+            return ("process", self.num_process)
+        batches = -(-times // self.batch_size)
+        if batches <= 1:
+            # nothing to split
+            return ("serial", 1)
+        from multiprocessing import cpu_count
+        limit = min(cpu_count(), batches)
+        cost = self.measure(plan, times)
+        if cost == None:
+            return ("serial", 1)
+        fixed, per_row, gil, send = cost
+        if self.shard_prefix != None and not self.generate_only:
+            # workers write their rows themselves
+            send = 0.0
+        serial = batches * fixed + times * per_row
+        estimates = [(serial, "serial", 1)]
+        for workers in range(2, limit + 1):
+            # threads only overlap the time spent outside the GIL,
+            # like waiting for the disk, processes overlap everything
+            # but have to start up and send their rows back
+            estimates.append((serial * (gil + (1 - gil) / workers),
+                              "thread", workers))
+            startup = PROCESS_STARTUP * workers
+            if "process" in self.pools:
+                if self.pools["process"][1] != workers:
+                    continue
+                startup = 0.0
+            estimates.append((startup + serial / workers + times * send,
+                              "process", workers))
+        best = min(estimates)
+        if best[0] > serial * PARALLEL_MARGIN:
+            # not worth the trouble of a pool
+            best = estimates[0]
+        if self.verbose:
+            print("[Info] print #%d: %d rows at %0.2fus/row (%d%% holding the GIL), "
+                  "estimated %0.3fs serial, using %s with %d worker(s), estimated %0.3fs"
+                  % (self.print_count, times, per_row * 1e6, gil * 100,
+                     estimates[0][0], best[1], best[2], best[0]), file=sys.stderr)
+        return (best[1], best[2])
+
+    def evaluate_parallel(self, plan, times, mode="process", workers=1):
+        from multiprocessing import Manager
+        from collections import deque
+        pool, workers = self.start_pool(mode, workers)
+        tasks, parts, partitionable = self.make_tasks(plan, times)
+        shared = None
+        if not partitionable:
+            # fall back to sharing the unique values of this print,
+            # through a manager between processes, started only when
+            # it is needed
+            if mode == "thread":
+                shared = (self.shared_unique(plan), threading.RLock())
+            else:
+                if self.manager == None:
+                    self.manager = Manager()
+                shared = (self.manager.dict(self.shared_unique(plan)),
+                          self.manager.RLock())
+        write = self.shard_prefix != None and not self.generate_only
+        table, retain = self.retained_columns(plan)
+        # every batch is a separate job, picked up by whichever worker
+        # is free. a window of at most two jobs per worker is kept in
+        # flight, and the results are collected in order, so a slow
+        # worker only holds back its own batch, and the parent never
+        # holds more than the window.
+        window = deque()
+        for i, (task, pools) in enumerate(zip(tasks, parts)):
+            path = None
+            if write:
+                path = self.shard_path(tasks, i)
+            window.append(pool.apply_async(run_task, (plan, task, pools,
+                                                      shared, path,
+                                                      self.output_format,
+                                                      self.profile != None,
+                                                      retain)))
+            if len(window) >= 2 * workers:
+                res = self.collect(window.popleft())
+                self.keep_keys(res, table, retain)
+                if not self.generate_only:
+                    yield res
+        while len(window) > 0:
+            res = self.collect(window.popleft())
+            self.keep_keys(res, table, retain)
+            if not self.generate_only:
+                yield res
+        if shared != None:
+            self.keep_unique(shared[0].copy())
+
+    def shard_path(self, tasks, i):
+        # shards of a resumed print follow the ones already written
+        first = self.state[str(self.print_count)]["batches"] - len(tasks)
+        return "%s.part%d.%d" % (self.shard_prefix, self.print_count, first + i)
+
+    def collect(self, job):
+        if self.profile == None:
+            return job.get()
+        # the time the driver spends waiting for the workers
+        start = time.perf_counter()
+        res, profile = job.get()
+        self.profile.add("print #%d" % self.print_count, "(wait for workers)",
+                         time.perf_counter() - start)
+        self.profile.merge(profile)
+        return res
+
+    def evaluate_serial(self, plan, times):
+        init_child(self.shared_unique(plan), nullcontext())
+        tasks, parts, _ = self.make_tasks(plan, times)
+        table, retain = self.retained_columns(plan)
+        for i, (task, pools) in enumerate(zip(tasks, parts)):
+            res = run_plan(plan, task, pools, self.profile)
+            self.keep_keys(res, table, retain)
+            if self.generate_only:
+                continue
+            if self.keep_shards:
+                res = write_shard(res, self.shard_path(tasks, i),
+                                  self.output_format, self.profile)
+            yield res
+        self.keep_unique(UNIQUE.dictionary)
 
     def visit_print(self, ast):
         times = int(ast.times.val)
-        if (times > 10000 or self.num_process != -1) and self.num_process != 1:
-            try:
-                return self.evaluate_parallel(ast)
-            except ImportError:
-                if self.num_process != -1:
-                    print("[Info] Python in this system does not support multiprocessing!\n"
-                          "[Info] Falling back to single process!")
-                pass
-        # either times < 10000 or import failed
-        init_child({}, nullcontext())
-        random.seed()
-        times = (times, random)
-        ret = self.visit_optional(ast.val, times)[0]
-        # print(ret)
-        return ret
+        self.print_count += 1
+        plan = self.compile(ast)
+        try:
+            mode, workers = self.choose_execution(plan, times)
+            if mode != "serial":
+                # Pool is imported on first iteration of the generator,
+                # so probe the import here to fall back in time
+                import multiprocessing.pool
+                return self.evaluate_parallel(plan, times, mode, workers)
+        except ImportError:
+            if self.num_process != -1:
+                print("[Info] Python in this system does not support multiprocessing!\n"
+                      "[Info] Falling back to single process!")
+            pass
+        # either serial is cheaper or import failed
+        return self.evaluate_serial(plan, times)
+
+    # expressions are not visited one by one anymore, they are
+    # compiled to a plan first, which is then evaluated as a whole
+
+    def evaluate_expression(self, ast, times):
+        seed = times[1].getrandbits(64)
+        return (run_plan(self.compile(ast), (times[0], seed, 0, seed)), False)
 
     def visit_literal(self, ast, times):
-        times = times[0]
-        if ast.val.type == Token.INTEGER:
-            return (repeat(int(ast.val.val), times), True)
-        else:
-            return (repeat(str(ast.val.val.replace("\"", "")), times), True)
+        return self.evaluate_expression(ast, times)
 
     def visit_variable(self, ast, times):
-        name = ast.val.val
-        if name in self.results:
-            return self.results[name]
-        elif name in self.grammars:
-            res = self.visit_optional(self.grammars[name], (*times, name))
-            self.results[name] = res
-            return res
-        elif name in self.defaultrules:
-            return (repeat(self.defaultrules[name], times[0]), True)
-        else:
-            raise EngineError("No such rule found '%s'!" % name)
+        return self.evaluate_expression(ast, times)
 
     def visit_function_call(self, ast, times):
-        if ast.func.val not in self.function_dictionary:
-            raise EngineError("Invalid function name '%s'!" % (ast.func))
-        func = self.function_dictionary[ast.func.val]
-        argc = self.argcount[ast.func.val]
-        if argc != -1 and len(ast.args) != argc:
-            raise EngineError("Function '%s' takes %d arguments, %d given!"
-                              % (ast.func.val, argc, len(ast.args)))
-
-        args = []
-        arg_is_constant = True
-        for arg in ast.args:
-            # temp now contains a collection of similar values
-            # which maybe marked as a constant
-            temp = self.visit_optional(arg, times)
-            arg_is_constant = arg_is_constant and temp[1]
-            # extract the raw collection and store it as argument
-            args.append(temp[0])
-        if arg_is_constant:
-            argsorted = repeat([next(y) for y in args], times[0])
-        else:
-            argsorted = zip(*args)
+        return self.evaluate_expression(ast, times)
 
-        res = []
-        if arg_is_constant:
-            func = self.vector_function_dictionary[ast.func.val]
-            return func(next(argsorted), times, times[-1])
-        else:
-            # send the Random object
-            res.extend(func(argsorted, times[1], times[-1])[0])
-            # Finally, wrap the result on a tuple
-            # and mark it as not constant
-            return (res, False)
+
+init_child({}, nullcontext())
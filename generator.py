@@ -1,8 +1,15 @@
 from scanner import Scanner, ScanError
 from my_parser import Parser, ParseError, PrettyPrinter, VisitorError
 from engine import Engine, EngineError
+from compiler import CompileError
+from output import BUFFER_SIZE, OutputFormat, OutputError, SqliteWriter, Writer
+from output import json_default, zstd_compress
+from cache import parse_cached
+from profiler import Profile
+import os
 import sys
 import argparse
+import json
 import time
 
 
@@ -19,30 +26,88 @@ def check_positive_generator(string):
                 "%s should be integer!" % string)
     return check_positive
 
-def try_run(source, engine, store_res=False):
-    scanner = Scanner(source)
-    res = []
+BOOTSTRAP = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "bootstrap.format")
+
+
+def parse(source):
+    return Parser(Scanner(source)).parse_all()
+
+
+def load_checkpoint(path):
+    # None when there is nothing to resume yet
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, checkpoint):
+    temp = "%s.%d" % (path, os.getpid())
+    with open(temp, "w") as f:
+        json.dump(checkpoint, f, default=json_default)
+    # a crash never leaves half a checkpoint behind
+    os.replace(temp, path)
+
+
+def truncate_output(path, size):
+    # drops whatever a failed run appended after the rows of the
+    # checkpoint, so that a retry does not write them twice
+    with open(path, "r+b") as f:
+        if f.seek(0, os.SEEK_END) < size:
+            raise OSError("'%s' is shorter than when the checkpoint was saved"
+                          % path)
+        f.truncate(size)
+
+
+def try_run(source, engine, writer=None, use_cache=True):
+    profile = engine.profile
     try:
-        parser = Parser(scanner)
-        ast = parser.parse_all()
+        start = time.perf_counter()
+        if use_cache:
+            ast = parse_cached(source, parse)
+        else:
+            ast = parse(source)
+        engine.prepare(ast)
+        if profile != None:
+            profile.add("input", "(parse)", time.perf_counter() - start,
+                        len(ast), len(source))
         for a in ast:
             r = a.accept(engine)
-            if r != None and store_res:
-                res.extend(r)
-        return (res, True)
+            if r != None:
+                # prints are evaluated lazily, batch by batch,
+                # so the batches have to be drained even if
+                # they are not written anywhere
+                for batch in r:
+                    if writer != None:
+                        start = time.perf_counter()
+                        writer(batch)
+                        if profile != None:
+                            profile.add("output", "(write)",
+                                        time.perf_counter() - start,
+                                        getattr(batch, "rows", None) or len(batch))
+        if writer != None:
+            writer.flush()
+        return True
     except ParseError as pe:
         print("[Error] Error occurred while parsing!")
         print(pe)
     except ScanError as se:
         print("[Error] Error occurred while scanning!")
         print(se)
+    except CompileError as ce:
+        print("[Error] Error occurred while compiling!")
+        print(ce)
     except EngineError as ee:
         print("[Error] Error occurred while evaluating!")
         print(ee)
+    except OutputError as oe:
+        print("[Error] Error occurred while writing!")
+        print(oe)
     except VisitorError as ve:
         print("[Error] Error in implementation!")
         print(ve)
-    return (None, False)
+    return False
 
 
 def main():
@@ -55,13 +120,56 @@ def main():
                            help="input file to read the format from")
     muexgroup.add_argument('output_file', nargs='?',
                            help="file to save generated data (default is stdout)")
+    muexgroup.add_argument('-d', '--sqlite', default=None, required=False,
+                           help="insert the generated data into the SQLite database DB",
+                           metavar='DB')
     muexgroup.add_argument('-g', '--generate', action='store_true', required=False,
                            help="generate, but don't write the generated data")
     parser.add_argument('-p', '--process', default=[-1], nargs=1, required=False,
                         type=check_positive_generator("Number of processes"),
                         help='use P processes to generate the data', metavar='P')
+    parser.add_argument('-b', '--batch-size', default=[10000], nargs=1, required=False,
+                        type=check_positive_generator("Batch size"),
+                        help='generate and write the data in batches of B rows', metavar='B')
+    parser.add_argument('-s', '--seed', default=[None], nargs=1, required=False,
+                        type=int, metavar='S',
+                        help="seed the random generators with S, the same seed "
+                        "and batch size give the same data with any number of processes")
+    parser.add_argument('-f', '--format', default='text', required=False,
+                        choices=OutputFormat.FORMATS,
+                        help="format of the written rows (default is text)")
+    parser.add_argument('-z', '--compress', default=None, required=False,
+                        choices=OutputFormat.COMPRESSIONS,
+                        help="compress the written data (default is gzip for "
+                        "output files ending with .gz, none otherwise)")
+    parser.add_argument('-r', '--insert-rows', default=[1000], nargs=1, required=False,
+                        type=check_positive_generator("Rows per INSERT"),
+                        help="put up to R rows in each INSERT of the sql format",
+                        metavar='R')
+    parser.add_argument('-q', '--sqlite-batch', default=[10000], nargs=1, required=False,
+                        type=check_positive_generator("Rows per transaction"),
+                        help="insert up to Q rows in each SQLite transaction",
+                        metavar='Q')
+    parser.add_argument('-k', '--keep-shards', action='store_true', required=False,
+                        help="write each batch to a file of its own, next to "
+                        "the output file, instead of concatenating them into it")
+    parser.add_argument('-n', '--no-cache', action='store_true', required=False,
+                        help="always scan and parse the format files, "
+                        "instead of reusing the cached results")
+    parser.add_argument('-C', '--checkpoint', default=None, required=False,
+                        help="continue the run saved in FILE if it exists, "
+                        "appending to the output file, and save the state "
+                        "of the run to FILE at the end", metavar='FILE')
+    parser.add_argument('-v', '--verbose', action='store_true', required=False,
+                        help="explain how each print is going to be evaluated")
     parser.add_argument('-t', '--time', action='store_true', required=False,
                         help="measure the time taken to generate the data")
+    parser.add_argument('-P', '--profile', action='store_true', required=False,
+                        help="report the time, calls, rows and bytes of each "
+                        "function, rule and worker on stderr")
+    parser.add_argument('--profile-json', default=None, required=False,
+                        help="also save the profile as JSON to FILE (implies -P)",
+                        metavar='FILE')
     testgroup.add_argument('-c', '--check', default=[], nargs=2, required=False,
                            type=check_positive_generator(
                                "Both of number of tests and lists"),
@@ -74,11 +182,45 @@ def main():
         tester.test_all(given.check[0], given.check[1])
         sys.exit(0)
 
-    e = Engine(given.generate, given.process[0])
+    compression = given.compress
+    if compression == None and given.output_file != None:
+        if given.output_file.endswith(".gz"):
+            compression = "gzip"
+        elif given.output_file.endswith(".zst"):
+            compression = "zstd"
+    if compression == "zstd" and zstd_compress() == None:
+        # never write anything else into a file named as zstd
+        parser.error("zstd compression needs Python 3.14 or newer")
+    if given.keep_shards and given.output_file == None:
+        # the shards are named after the output file
+        parser.error("-k/--keep-shards needs an output file")
+    fmt = OutputFormat(given.format, given.insert_rows[0], compression)
+    profile = None
+    if given.profile or given.profile_json != None:
+        profile = Profile()
+    e = Engine(given.generate, given.process[0], given.batch_size[0],
+               given.output_file, given.seed[0], given.verbose, fmt, profile,
+               given.keep_shards)
+    checkpoint = None
+    if given.checkpoint != None:
+        try:
+            checkpoint = load_checkpoint(given.checkpoint)
+            if checkpoint != None:
+                if given.seed[0] != None and given.seed[0] != checkpoint.get("seed"):
+                    print("[Warn] Ignoring the seed, and using the one of the checkpoint!")
+                e.resume(checkpoint)
+        except (OSError, ValueError) as err:
+            print("[Error] Unable to read the checkpoint '%s': %s"
+                  % (given.checkpoint, err))
+            return
+        except EngineError as ee:
+            print("[Error] %s" % ee)
+            return
     bootstrap_loaded = False
-    with open("bootstrap.format", "r") as f:
+    use_cache = not given.no_cache
+    with open(BOOTSTRAP, "r") as f:
         source = f.read()
-        res, bootstrap_loaded = try_run(source, e, False)
+        bootstrap_loaded = try_run(source, e, use_cache=use_cache)
 
     if bootstrap_loaded == False:
         print("[Warn] Loading bootstrap module failed!")
@@ -86,26 +228,72 @@ def main():
 
     with open(given.input_file, "r") as g:
         source = g.read()
-        scanner = Scanner(source)
-        parser = Parser(scanner)
-        if given.time:
-            start = time.perf_counter()
-        res, success = try_run(source, e, given.generate == False)
-        if success == False:
-            print("[Error] Generation failed!")
-            return
-        if given.time:
-            print("Time elapsed: %0.5f" %
-                    (time.perf_counter() - start) + "s")
-
-        if given.generate == False:
-            if given.output_file != None:
-                with open(given.output_file, "w") as h:
-                    for line in res:
-                        h.write(str(line) + "\n")
-            else:
-                for line in res:
-                    print(line)
+
+    # what was written by the end of the run, kept in the checkpoint
+    written = {}
+    resumed = {}
+    if checkpoint != None:
+        resumed = checkpoint.get("output", {})
+    if given.time:
+        start = time.perf_counter()
+    try:
+        if given.generate:
+            success = try_run(source, e, use_cache=use_cache)
+        elif given.sqlite != None:
+            try:
+                w = SqliteWriter(given.sqlite, given.sqlite_batch[0])
+            except OutputError as oe:
+                print("[Error] %s" % oe)
+                return
+            try:
+                if "tables" in resumed:
+                    w.truncate(resumed["tables"])
+                success = try_run(source, e, w, use_cache)
+                if success:
+                    written["tables"] = dict(resumed.get("tables", {}))
+                    written["tables"].update(w.last_rows())
+            except OutputError as oe:
+                print("[Error] %s" % oe)
+                return
+            finally:
+                w.close()
+        elif given.output_file != None:
+            # a resumed run adds its rows to the ones already written
+            mode = "ab" if checkpoint != None else "wb"
+            if "bytes" in resumed:
+                try:
+                    truncate_output(given.output_file, resumed["bytes"])
+                except OSError as err:
+                    print("[Error] Unable to resume the output: %s" % err)
+                    return
+            with open(given.output_file, mode, buffering=BUFFER_SIZE) as h:
+                success = try_run(source, e, Writer(h, fmt, given.keep_shards,
+                                                    checkpoint == None),
+                                  use_cache)
+            if success:
+                written["bytes"] = os.path.getsize(given.output_file)
+        else:
+            # write the bytes straight to the buffer of stdout, instead
+            # of going through its line buffered text layer
+            sys.stdout.flush()
+            success = try_run(source, e, Writer(sys.stdout.buffer, fmt), use_cache)
+            sys.stdout.buffer.flush()
+    finally:
+        e.close()
+    if profile != None:
+        profile.report(sys.stderr)
+        if given.profile_json != None:
+            profile.dump(given.profile_json)
+    if success == False:
+        print("[Error] Generation failed!")
+        return
+    if given.checkpoint != None:
+        state = e.checkpoint()
+        state["output"] = written
+        save_checkpoint(given.checkpoint, state)
+    if given.time:
+        print("Time elapsed: %0.5f" %
+                (time.perf_counter() - start) + "s")
 
 if __name__ == "__main__":
     main()
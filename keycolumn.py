@@ -0,0 +1,110 @@
+from array import array
+from linefile import LineFile
+import mmap
+
+
+def compact(values):
+    # integers as a raw int64 array, anything else as a list
+    values = list(values)
+    if not any(isinstance(v, (bool, str, float)) for v in values):
+        try:
+            return array('q', values)
+        except (OverflowError, TypeError):
+            pass
+    return values
+
+
+def column_values(batch, column):
+    # the values of one column of a batch of records
+    i = batch.columns.index(column)
+    return compact([row[i] for row in batch])
+
+
+class KeyColumn:
+    # A column of a printed table, kept to draw foreign keys from in
+    # the prints after it. The values are appended to a file as the
+    # batches are generated, as raw int64 while they are all integers,
+    # or as lines along with the offset of each one, so neither the
+    # driver nor the workers keep them in memory, and the workers only
+    # need the path to memory map them.
+
+    def __init__(self, path):
+        self.path = path
+        self.integers = True
+        self.count = 0
+        # offset of the end of the text written so far
+        self.end = 0
+        open(path, "wb").close()
+
+    def extend(self, values):
+        if len(values) == 0:
+            return
+        if self.integers and not isinstance(values, array):
+            values = compact(values)
+            if not isinstance(values, array):
+                self.to_lines()
+        if self.integers:
+            with open(self.path, "ab") as f:
+                values.tofile(f)
+        else:
+            self.write_lines(values)
+        self.count += len(values)
+
+    def write_lines(self, values):
+        data = [(str(v) + "\n").encode() for v in values]
+        offsets = array('q')
+        for d in data:
+            self.end += len(d)
+            offsets.append(self.end)
+        with open(self.path, "ab") as f:
+            f.write(b"".join(data))
+        with open(self.path + ".index", "ab") as f:
+            offsets.tofile(f)
+
+    def to_lines(self):
+        # some value is not an integer, so rewrite the ones so far as
+        # text, to a new file, as workers may still map the old one
+        values = array('q')
+        with open(self.path, "rb") as f:
+            values.frombytes(f.read())
+        self.path += ".lines"
+        self.integers = False
+        self.end = 0
+        open(self.path, "wb").close()
+        with open(self.path + ".index", "wb") as f:
+            # the start of the first line
+            array('q', [0]).tofile(f)
+        self.write_lines(values)
+
+    def reference(self):
+        # all a worker needs to open the column, and to tell apart
+        # the versions of a table printed more than once
+        return (self.path, self.integers, self.count)
+
+
+class IntegerKeys:
+
+    def __init__(self, path, count):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.values = memoryview(self.data).cast('q')[:count]
+        self.count = count
+
+    def lines(self, picked):
+        values = self.values
+        return [values[i] for i in picked]
+
+
+# columns are opened once per process, as mmaps cannot be pickled
+KEY_COLUMNS = {}
+
+
+def open_key_column(reference):
+    # returns an object with the count of the keys, and lines(picked)
+    if reference not in KEY_COLUMNS:
+        path, integers, count = reference
+        if integers:
+            KEY_COLUMNS[reference] = IntegerKeys(path, count)
+        else:
+            KEY_COLUMNS[reference] = LineFile(path, path + ".index", count)
+    return KEY_COLUMNS[reference]
@@ -0,0 +1,71 @@
+from array import array
+from cache import cache_path, store
+import mmap
+import os
+
+
+class LineFile:
+    # A newline delimited file, memory mapped, along with the offset
+    # of the start of each line. The offsets are cached on disk, so
+    # a file is only scanned once, and both the file and its index
+    # are paged in by the OS only as lines are drawn. A file written
+    # along with its offsets instead gives their file, and the number
+    # of its lines to use.
+
+    def __init__(self, path, index=None, count=None):
+        self.path = path
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size == 0:
+                raise OSError("'%s' is empty!" % path)
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if index == None:
+            key = "%s:%d:%d" % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+            index = cache_path("lines", key.encode(), "index")
+            if not os.path.exists(index):
+                store(index, self.build_index(), lambda a, f: a.tofile(f))
+        try:
+            with open(index, "rb") as f:
+                self.index = memoryview(mmap.mmap(f.fileno(), 0,
+                                                  access=mmap.ACCESS_READ)).cast('q')
+        except (OSError, ValueError):
+            # the cache is not writable, keep the index in memory
+            self.index = self.build_index()
+        # the index has one more offset than lines, marking the end
+        if count != None:
+            self.index = self.index[:count + 1]
+        self.count = len(self.index) - 1
+        if self.count == 0:
+            raise OSError("'%s' has no lines!" % path)
+
+    def build_index(self):
+        data = self.data
+        offsets = array('q', [0])
+        pos = data.find(b"\n")
+        while pos != -1:
+            offsets.append(pos + 1)
+            pos = data.find(b"\n", pos + 1)
+        if offsets[-1] != len(data):
+            # the last line is not terminated
+            offsets.append(len(data) + 1)
+        return offsets
+
+    def line(self, i):
+        # the line without its newline
+        return self.data[self.index[i]:self.index[i + 1] - 1].decode().rstrip("\r")
+
+    def lines(self, picked):
+        data = self.data
+        index = self.index
+        return [data[index[i]:index[i + 1] - 1].decode().rstrip("\r")
+                for i in picked]
+
+
+# files are opened once per process, as mmaps cannot be pickled
+LINE_FILES = {}
+
+
+def open_line_file(path):
+    if path not in LINE_FILES:
+        LINE_FILES[path] = LineFile(path)
+    return LINE_FILES[path]
@@ -0,0 +1,317 @@
+import csv
+import gzip
+import io
+import json
+import numbers
+import os
+import shutil
+import sys
+
+
+class OutputError(Exception):
+    pass
+
+
+class Records(list):
+    # rows of a record(), along with the names of its columns,
+    # and the rule it was printed as
+
+    def __init__(self, rows, columns, table=None):
+        list.__init__(self, rows)
+        self.columns = columns
+        self.table = table
+
+
+class Shard:
+    # a part of a print which was already written to a
+    # file by a worker process
+
+    def __init__(self, path, rows, columns=None, table=None, keys={}):
+        self.path = path
+        self.rows = rows
+        self.columns = columns
+        self.table = table
+        # the columns kept for foreign keys, by name
+        self.keys = keys
+
+    def __repr__(self):
+        return self.path
+
+
+def zstd_compress():
+    # only part of the standard library from Python 3.14
+    try:
+        from compression.zstd import compress
+        return compress
+    except ImportError:
+        return None
+
+
+def json_default(value):
+    # numpy scalars
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+def sql_value(value):
+    if value == None:
+        return "NULL"
+    if isinstance(value, numbers.Number) and not isinstance(value, bool):
+        return str(value)
+    # a backslash escapes the next character in MySQL
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "''") + "'"
+
+
+class OutputFormat:
+    # turns batches into text, in the same way in the driver and in
+    # the workers writing their own shards
+
+    FORMATS = ("text", "csv", "tsv", "jsonl", "sql")
+    COMPRESSIONS = ("gzip", "zstd")
+
+    def __init__(self, name="text", insert_rows=1000, compression=None):
+        self.name = name
+        # rows in each INSERT statement of the sql format
+        self.insert_rows = insert_rows
+        self.compression = compression
+        if compression == "zstd" and zstd_compress() == None:
+            raise OutputError("zstd needs Python 3.14 or newer!")
+
+    def block(self, text):
+        # the encoded, and maybe compressed, bytes of some text. each
+        # block is compressed on its own, as a complete gzip member or
+        # zstd frame, and a stream of those decompresses as a whole. so
+        # blocks compressed by different workers can just be appended.
+        data = text.encode()
+        if self.compression == "gzip":
+            # no timestamp, so that the same data compresses the same
+            return gzip.compress(data, compresslevel=6, mtime=0)
+        if self.compression == "zstd":
+            return zstd_compress()(data)
+        return data
+
+    def columns(self, batch):
+        # plain values are a single column
+        columns = getattr(batch, "columns", None)
+        if columns == None:
+            return ("value",)
+        return columns
+
+    def rows(self, batch):
+        if getattr(batch, "columns", None) == None:
+            return [(v,) for v in batch]
+        return batch
+
+    def header(self, batch):
+        # written once before the rows of a table
+        if getattr(batch, "columns", None) == None:
+            return ""
+        if self.name == "csv" or self.name == "tsv":
+            return self.lines(Records([batch.columns], batch.columns))
+        return ""
+
+    def lines(self, batch):
+        if self.name == "text":
+            if getattr(batch, "columns", None) == None:
+                return "".join([str(line) + "\n" for line in batch])
+            return "".join(["\t".join(map(str, row)) + "\n" for row in batch])
+        if self.name == "csv" or self.name == "tsv":
+            buf = io.StringIO()
+            w = csv.writer(buf, delimiter="," if self.name == "csv" else "\t",
+                           lineterminator="\n")
+            w.writerows(self.rows(batch))
+            return buf.getvalue()
+        if self.name == "jsonl":
+            if getattr(batch, "columns", None) == None:
+                return "".join([json.dumps(v, default=json_default) + "\n"
+                                for v in batch])
+            columns = batch.columns
+            return "".join([json.dumps(dict(zip(columns, row)),
+                                       default=json_default) + "\n"
+                            for row in batch])
+        # sql, a single INSERT for up to insert_rows rows
+        rows = self.rows(batch)
+        table = getattr(batch, "table", None) or "data"
+        start = "INSERT INTO `%s`(%s) VALUES\n" % (
+            table, ", ".join(["`%s`" % c for c in self.columns(batch)]))
+        res = []
+        for i in range(0, len(rows), self.insert_rows):
+            values = ["(" + ", ".join(map(sql_value, row)) + ")"
+                      for row in rows[i:i + self.insert_rows]]
+            res.append(start + ",\n".join(values) + ";\n")
+        return "".join(res)
+
+
+# size of the buffer of the output files
+BUFFER_SIZE = 1 << 20
+
+
+def write_lines(handle, batch, fmt=OutputFormat()):
+    # handle is a binary file, which receives the whole
+    # batch in one call
+    handle.write(fmt.block(fmt.lines(batch)))
+
+
+def append_shard(handle, shard, keep=False):
+    # shards are already encoded, just copy the bytes
+    with open(shard.path, "rb") as s:
+        shutil.copyfileobj(s, handle, BUFFER_SIZE)
+    if not keep:
+        os.remove(shard.path)
+
+
+def prepend(path, data):
+    with open(path, "rb") as s:
+        rest = s.read()
+    with open(path, "wb") as s:
+        s.write(data)
+        s.write(rest)
+
+
+class Writer:
+    # writes the batches of every print to a binary handle, along with
+    # the header of each table the first time its columns show up
+
+    def __init__(self, handle, fmt=OutputFormat(), keep_shards=False,
+                 headers=True):
+        self.handle = handle
+        self.fmt = fmt
+        self.keep_shards = keep_shards
+        # off when appending to the file of an earlier run
+        self.headers = headers
+        self.columns = None
+
+    def header(self, batch):
+        # the encoded header, when the columns of the batch start a table
+        columns = getattr(batch, "columns", None)
+        header = b""
+        if self.headers and columns != None and columns != self.columns:
+            text = self.fmt.header(batch)
+            if text != "":
+                header = self.fmt.block(text)
+        self.columns = columns
+        return header
+
+    def flush(self):
+        self.handle.flush()
+
+    def __call__(self, batch):
+        header = self.header(batch)
+        if isinstance(batch, Shard) and self.keep_shards:
+            # the shards are the output, so the header of a table
+            # goes at the start of its first shard
+            if header != b"":
+                prepend(batch.path, header)
+            print("[Info] Written %d rows to '%s'" % (batch.rows, batch.path))
+            return
+        if header != b"":
+            self.handle.write(header)
+        if isinstance(batch, Shard):
+            append_shard(self.handle, batch)
+        else:
+            write_lines(self.handle, batch, self.fmt)
+
+
+def sqlite_name(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+class SqliteWriter:
+    # inserts the batches straight into a SQLite database, in
+    # transactions of up to batch_rows rows each, collected across
+    # the batches of a print
+
+    def __init__(self, path, batch_rows=10000):
+        import sqlite3
+        self.sqlite3 = sqlite3
+        self.error = sqlite3.Error
+        # whether the adapters of the numpy values are registered
+        self.adapted = False
+        try:
+            self.db = sqlite3.connect(path)
+            # a generated test database can be regenerated, so don't
+            # wait for the disk on every commit
+            self.db.execute("PRAGMA synchronous = OFF")
+        except sqlite3.Error as e:
+            raise OutputError("Unable to open '%s': %s" % (path, e))
+        self.batch_rows = batch_rows
+        self.fmt = OutputFormat()
+        self.statements = {}
+        # rows not inserted yet, all for the statement insert
+        self.insert = None
+        self.pending = []
+
+    def statement(self, batch):
+        table = getattr(batch, "table", None) or "data"
+        columns = self.fmt.columns(batch)
+        if (table, columns) not in self.statements:
+            names = ", ".join([sqlite_name(c) for c in columns])
+            quoted = sqlite_name(table)
+            try:
+                self.db.execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (quoted, names))
+            except self.error as e:
+                raise OutputError("Unable to create table '%s': %s" % (table, e))
+            self.statements[(table, columns)] = "INSERT INTO %s (%s) VALUES (%s)" % (
+                quoted, names, ", ".join(["?"] * len(columns)))
+        return self.statements[(table, columns)]
+
+    def adapt_numpy(self):
+        # numpy values only show up once the engine has imported numpy
+        numpy = sys.modules.get("numpy")
+        if numpy != None:
+            for t in (numpy.int64, numpy.int32, numpy.float64, numpy.str_):
+                self.sqlite3.register_adapter(t, lambda v: v.item())
+            self.adapted = True
+
+    def __call__(self, batch):
+        if not self.adapted:
+            self.adapt_numpy()
+        insert = self.statement(batch)
+        if insert != self.insert:
+            self.flush()
+            self.insert = insert
+        self.pending.extend(self.fmt.rows(batch))
+        if len(self.pending) >= self.batch_rows:
+            full = len(self.pending) - len(self.pending) % self.batch_rows
+            for i in range(0, full, self.batch_rows):
+                self.commit(self.pending[i:i + self.batch_rows])
+            del self.pending[:full]
+
+    def commit(self, rows):
+        try:
+            with self.db:
+                self.db.executemany(self.insert, rows)
+        except self.error as e:
+            raise OutputError("Unable to insert into the database: %s" % e)
+
+    def flush(self):
+        if len(self.pending) > 0:
+            self.commit(self.pending)
+        self.pending = []
+
+    def last_rows(self):
+        # the last rowid of each table written to, so that a resumed
+        # run can drop whatever a failed run inserted after them
+        res = {}
+        for table, _ in self.statements:
+            try:
+                last = self.db.execute("SELECT max(rowid) FROM %s"
+                                       % sqlite_name(table)).fetchone()[0]
+            except self.error as e:
+                raise OutputError("Unable to read table '%s': %s" % (table, e))
+            res[table] = last or 0
+        return res
+
+    def truncate(self, last_rows):
+        try:
+            with self.db:
+                for table, last in last_rows.items():
+                    self.db.execute("DELETE FROM %s WHERE rowid > ?"
+                                    % sqlite_name(table), (last,))
+        except self.error as e:
+            raise OutputError("Unable to drop the rows of a failed run: %s" % e)
+
+    def close(self):
+        # rows still pending were not flushed because the run failed
+        self.db.close()
@@ -0,0 +1,136 @@
+import json
+import threading
+import time
+
+
+def worker_name():
+    # the thread inside a thread pool, the process otherwise
+    thread = threading.current_thread()
+    if thread is not threading.main_thread():
+        return thread.name
+    # only imported when profiling, as it is slow to import
+    import multiprocessing
+    name = multiprocessing.current_process().name
+    if name == "MainProcess":
+        return "main"
+    return name
+
+
+def rule_name(key):
+    # keys are "rule#slot", or (columns, table) for a record
+    if isinstance(key, tuple):
+        return key[1] or "print"
+    return key.split("#")[0]
+
+
+def column_bytes(values):
+    # length of the values as they would be written as text
+    size = 0
+    for v in values:
+        if isinstance(v, tuple):
+            size += sum([len(str(x)) for x in v])
+        else:
+            size += len(str(v))
+    return size
+
+
+class StepTimer:
+    # wall time of the steps of a plan, without the time of the steps
+    # they pull rows from. the steps being timed form a stack, and the
+    # time of each one is taken off the one it was called from.
+
+    def __init__(self):
+        self.stack = []
+
+    def enter(self):
+        self.stack.append(0.0)
+        return time.perf_counter()
+
+    def leave(self, start):
+        elapsed = time.perf_counter() - start
+        inner = self.stack.pop()
+        if len(self.stack) > 0:
+            self.stack[-1] += elapsed
+        return elapsed - inner
+
+
+class TimedColumn:
+    # passes the rows of a lazy column through as they are pulled, and
+    # adds up their count, their bytes and the time spent making them,
+    # so that a column is timed without being built any earlier than
+    # it would be, which would change the order of the random draws.
+
+    def __init__(self, values, timer):
+        self.values = iter(values)
+        self.timer = timer
+        self.rows = 0
+        self.size = 0
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = self.timer.enter()
+        try:
+            value = next(self.values)
+        finally:
+            self.seconds += self.timer.leave(start)
+        self.rows += 1
+        self.size += column_bytes((value,))
+        return value
+
+
+class Profile:
+    # wall time, calls, rows and bytes of every function, for each
+    # rule and each worker it was evaluated in. a worker fills one
+    # of these for each batch, and sends it back along with the
+    # batch to be merged by the driver.
+
+    FIELDS = ("calls", "rows", "bytes", "seconds")
+
+    def __init__(self):
+        # (worker, rule, function) -> [calls, rows, bytes, seconds]
+        self.entries = {}
+
+    def add(self, rule, function, seconds, rows=0, size=0, worker=None):
+        if worker == None:
+            worker = worker_name()
+        entry = self.entries.setdefault((worker, rule, function), [0, 0, 0, 0.0])
+        entry[0] += 1
+        entry[1] += rows
+        entry[2] += size
+        entry[3] += seconds
+
+    def merge(self, other):
+        for key, value in other.entries.items():
+            entry = self.entries.setdefault(key, [0, 0, 0, 0.0])
+            for i in range(len(entry)):
+                entry[i] += value[i]
+
+    def totals(self, by):
+        # by is the index of the key to group the entries with
+        res = {}
+        for key, value in self.entries.items():
+            entry = res.setdefault(key[by], [0, 0, 0, 0.0])
+            for i in range(len(entry)):
+                entry[i] += value[i]
+        return sorted(res.items(), key=lambda x: x[1][3], reverse=True)
+
+    def report(self, handle):
+        total = sum([v[3] for v in self.entries.values()]) or 1.0
+        for title, by in (("function", 2), ("rule", 1), ("worker", 0)):
+            print("[Profile] %-28s %10s %12s %14s %10s %6s"
+                  % ("by " + title, "calls", "rows", "bytes", "seconds", "%"),
+                  file=handle)
+            for name, (calls, rows, size, seconds) in self.totals(by):
+                print("[Profile] %-28s %10d %12d %14d %10.4f %5.1f%%"
+                      % (name, calls, rows, size, seconds, seconds * 100 / total),
+                      file=handle)
+
+    def dump(self, path):
+        entries = [dict(zip(("worker", "rule", "function") + self.FIELDS,
+                            key + tuple(value)))
+                   for key, value in sorted(self.entries.items())]
+        with open(path, "w") as f:
+            json.dump({"entries": entries}, f, indent=1)
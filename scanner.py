@@ -1,3 +1,6 @@
+import re
+
+
 class Token:
     # types
     IDENTIFIER = 0
@@ -33,75 +36,68 @@ class Scanner:
                '=': Token.EQUALS,
                ',': Token.COMMA}
 
+    # one alternative for each kind of token, tried in order, after
+    # skipping the whitespace before it. the whole source is
+    # tokenized by the regex engine in a single pass.
+    PATTERN = re.compile(r"""
+        [ \t\r\n]*
+        (?:
+        (?P<identifier>[^\W\d_][^\W\d]*)
+      | (?P<integer>\d+)
+      | (?P<string>"[^"]*")
+      | (?P<symbol>[.()=,])
+      | (?P<error>[^ \t\r\n])
+        )
+    """, re.VERBOSE | re.DOTALL)
+
     def __init__(self, source):
-        self.pos = -1
-        self.start = 0
-        self.length = len(source)
         self.source = source
+        self.length = len(source)
+        self.tokens = self.tokenize(source)
+        self.pos = 0
 
-    def advance(self):
-        self.pos += 1
+    def tokenize(self, source):
+        tokens = []
+        append = tokens.append
+        keywords = Token.KEYWORDS
+        symbols = self.SYMBOLS
+        for m in self.PATTERN.finditer(source):
+            kind = m.lastgroup
+            part = m.group(kind)
+            if kind == "identifier":
+                append(Token(keywords.get(part, Token.IDENTIFIER), part))
+            elif kind == "string":
+                append(Token(Token.STRING, part))
+            elif kind == "integer":
+                append(Token(Token.INTEGER, part))
+            elif kind == "symbol":
+                append(Token(symbols[part], part))
+            elif part == '"':
+                raise ScanError("String not terminated properly!")
+            else:
+                raise ScanError("Undefined symbol '%s'" % part)
+        append(Token(Token.EOF, ""))
+        return tokens
+
+    def peek(self):
+        return self.tokens[self.pos]
 
     def match(self, c):
-        if self.peek() == c:
-            self.advance()
+        if self.tokens[self.pos].val == c:
+            self.pos += 1
             return True
         return False
 
     def is_at_end(self):
-        return self.pos >= (self.length - 1)
-
-    def make_token(self, typ):
-        part = self.source[self.start:self.pos + 1]
-        if typ == Token.IDENTIFIER and part in Token.KEYWORDS:
-            typ = Token.KEYWORDS[part]
-        return Token(typ, part)
-
-    def peek(self):
-        if self.pos < self.length - 1:
-            return self.source[self.pos + 1]
-        return self.source[self.pos]
-
-    def number(self):
-        while(self.peek().isdigit()):
-            self.advance()
-        return self.make_token(Token.INTEGER)
-
-    def identifier(self):
-        while(self.peek().isalpha() or self.peek() == '_'):
-            self.advance()
-        return self.make_token(Token.IDENTIFIER)
-
-    def string(self):
-        while(self.peek() != '"' and not self.is_at_end()):
-            self.advance()
-        if not self.is_at_end():
-            self.advance()
-        else:
-            raise ScanError("String not terminated properly!")
-        return self.make_token(Token.STRING)
+        return self.tokens[self.pos].type == Token.EOF
 
     def scan_next(self):
-        self.advance()
-        if self.pos == self.length:
-            return self.make_token(Token.EOF)
-        self.start = self.pos
-        c = self.source[self.start]
-        if(c.isalpha()):
-            return self.identifier()
-        elif(c.isdigit()):
-            return self.number()
-        elif(c == '"'):
-            return self.string()
-        elif(c in self.SYMBOLS):
-            return self.make_token(self.SYMBOLS[c])
-        elif(c == ' ' or c == '\n' or c == '\r' or c == '\t'):
-            return self.scan_next()
-        else:
-            raise ScanError("Undefined symbol '%s'" % c)
+        token = self.tokens[self.pos]
+        if token.type != Token.EOF:
+            self.pos += 1
+        return token
 
     def scan_all(self):
-        tokens = []
-        while(self.pos != self.length):
-            tokens.append(self.scan_next())
+        tokens = self.tokens[self.pos:]
+        self.pos = len(self.tokens) - 1
         return tokens
@@ -1,6 +1,10 @@
-from engine import append, append_times, between, between_times
+from engine import append, append_times, append_columns, between, between_times
 from engine import one_of, one_of_times, one_of_unique, one_of_unique_times
-from engine import lower, lower_times, upto, upto_times
+from engine import lower, lower_times, upto, upto_times, one_of_file_times
+from engine import one_of_weighted_times, sequence_columns
+from engine import number_between_unique_columns, foreign_key_columns
+from engine import NUMPY_MIN_ROWS
+from keycolumn import KeyColumn
 from engine import init_child, NullManager
 from contextlib import nullcontext
 import random
@@ -10,6 +14,8 @@ import sys
 import time
 import platform
 import json
+import tempfile
+import os
 
 finalset = ascii_letters + digits + punctuation
 r = random
@@ -62,7 +68,7 @@ def test_append(times,  numlists=100):
     for _ in range(times):
         s = [generate_random_string_list(r, finalset) for _ in range(numlists)]
         elapsed = time.perf_counter()
-        reslist = append(s, r)[0] # select only the result
+        reslist = list(append(s, r)[0]) # select only the result
         elapsed = time.perf_counter() - elapsed
         if len(reslist) != len(s):
             errstr = "Expected length %d, received %d" % (len(s), len(reslist))
@@ -82,7 +88,7 @@ def test_append_times(times, numlists=100):
         s = generate_random_string_list(r, finalset)
         result = ''.join(s)
         elapsed = time.perf_counter()
-        reslist = append_times([s], (numlists, r))[0]
+        reslist = append_times(s, (numlists, r))[0]
         elapsed = time.perf_counter() - elapsed
         success = True
         errstr = ''
@@ -101,11 +107,113 @@ def test_append_times(times, numlists=100):
         yield (success, errstr, elapsed)
 
 
+def test_append_columns(times, numlists=100):
+    for _ in range(times):
+        # alternate between variable and constant columns
+        s = [(generate_random_string_list(r, finalset, numwords=numlists), False)
+             if i % 2 == 0 else (''.join(r.choices(finalset, k=10)), True)
+             for i in range(10)]
+        elapsed = time.perf_counter()
+        reslist = list(append_columns(s, (numlists, r))[0])
+        elapsed = time.perf_counter() - elapsed
+        if len(reslist) != numlists:
+            errstr = "Expected length %d, received %d" % (numlists, len(reslist))
+            yield (False, errstr)
+        else:
+            success = True
+            errstr = ''
+            for i, res in enumerate(reslist):
+                if ''.join([c if const else c[i] for c, const in s]) != res:
+                    errstr = "String not matched!"
+                    success = False
+                    break
+            yield (success, errstr, elapsed)
+
+def test_sequence_columns(times, numlists=100):
+    for j in range(times):
+        first = r.randint(0, 1000000)
+        step = (r.randint(-100, 100), True)
+        # alternate between a constant and a variable start
+        if j % 2 == 0:
+            start = (r.randint(-1000, 1000), True)
+        else:
+            start = ([r.randint(-1000, 1000) for _ in range(numlists)], False)
+        elapsed = time.perf_counter()
+        reslist = list(sequence_columns([start, step], (numlists, r, first))[0])
+        elapsed = time.perf_counter() - elapsed
+        if len(reslist) != numlists:
+            errstr = "Expected length %d, received %d" % (numlists, len(reslist))
+            yield (False, errstr)
+        else:
+            success = True
+            errstr = ''
+            for i, res in enumerate(reslist):
+                s = start[0] if start[1] else start[0][i]
+                if res != s + step[0] * (first + i):
+                    errstr = "%d is not row %d of sequence(%d, %d)!" % (res, first + i, s, step[0])
+                    success = False
+                    break
+            yield (success, errstr, elapsed)
+
+def test_number_between_unique_columns(times, numlists=100):
+    for j in range(times):
+        lower = r.randint(0, 1000000)
+        upper = lower + r.randint(2 * numlists, 100 * numlists)
+        bounds = [(lower, True), (upper, True)]
+        seed = r.getrandbits(64)
+        elapsed = time.perf_counter()
+        # two consecutive batches of the same print
+        res = list(number_between_unique_columns(bounds, (numlists, r, 0, seed), "test#%d" % j)[0])
+        res += list(number_between_unique_columns(bounds, (numlists, r, numlists, seed), "test#%d" % j)[0])
+        elapsed = time.perf_counter() - elapsed
+        if len(res) != 2 * numlists:
+            errstr = "Expected length %d, received %d" % (2 * numlists, len(res))
+            yield (False, errstr)
+        elif len(set(res)) != len(res):
+            yield (False, "Values are not unique!")
+        else:
+            success = True
+            errstr = ''
+            for x in res:
+                if x not in range(lower, upper + 1):
+                    errstr = "%d is not between(%d, %d)!" % (x, lower, upper)
+                    success = False
+                    break
+            yield (success, errstr, elapsed)
+
+def test_number_between_unique_widest(times, numlists=100):
+    # enough rows for the numpy path, over the widest ranges allowed
+    numlists = max(numlists, NUMPY_MIN_ROWS)
+    ranges = [(0, (1 << 64) - 1), (-(1 << 63), (1 << 63) - 1),
+              (-(1 << 64), -1), ((1 << 64) + 5, (1 << 65) + 4)]
+    for j in range(times):
+        lower, upper = ranges[j % len(ranges)]
+        bounds = [(lower, True), (upper, True)]
+        seed = r.getrandbits(64)
+        elapsed = time.perf_counter()
+        res = list(number_between_unique_columns(bounds, (numlists, r, 0, seed), "test#%d" % j)[0])
+        elapsed = time.perf_counter() - elapsed
+        res = [int(x) for x in res]
+        if len(res) != numlists:
+            errstr = "Expected length %d, received %d" % (numlists, len(res))
+            yield (False, errstr)
+        elif len(set(res)) != len(res):
+            yield (False, "Values are not unique!")
+        else:
+            success = True
+            errstr = ''
+            for x in res:
+                if x < lower or x > upper:
+                    errstr = "%d is not between(%d, %d)!" % (x, lower, upper)
+                    success = False
+                    break
+            yield (success, errstr, elapsed)
+
 def test_between(times, numlists=100):
     for _ in range(times):
         ranges = [(random.randint(100, 500), random.randint(500, 1000)) for _ in range(numlists)]
         elapsed = time.perf_counter()
-        res = between(ranges, r)[0]
+        res = list(between(ranges, r)[0])
         elapsed = time.perf_counter() - elapsed
         if len(ranges) != len(res):
             errstr = "Unexpected length!"
@@ -121,6 +229,27 @@ def test_between(times, numlists=100):
                     break
             yield (success, errstr, elapsed)
 
+def test_between_reversed(times, numlists=100):
+    # rows with the bounds swapped, on both the python and numpy paths
+    for j in range(times):
+        count = max(numlists, NUMPY_MIN_ROWS) if j % 2 else min(numlists, NUMPY_MIN_ROWS - 1)
+        ranges = [(random.randint(500, 1000), random.randint(100, 500)) for _ in range(count)]
+        elapsed = time.perf_counter()
+        res = list(between(ranges, r)[0])
+        elapsed = time.perf_counter() - elapsed
+        if len(ranges) != len(res):
+            errstr = "Unexpected length!"
+            yield (False, errstr)
+        else:
+            success = True
+            errstr = ''
+            for x in zip(ranges, res):
+                if x[1] not in range(x[0][1], x[0][0] + 1):
+                    errstr = "%d is not between(%d, %d)!" % (int(x[1]), int(x[0][0]), int(x[0][1]))
+                    success = False
+                    break
+            yield (success, errstr, elapsed)
+
 def test_between_times(times, numlists=100):
     for _ in range(times):
         down = random.randint(100, 500)
@@ -146,7 +275,7 @@ def test_one_of(times, numlist=100):
     for _ in range(times):
         sources = [generate_random_string_list(r, finalset) for _ in range(numlist)]
         elapsed = time.perf_counter()
-        of = one_of(sources, r)[0]
+        of = list(one_of(sources, r)[0])
         elapsed = time.perf_counter() - elapsed
         if len(of) != numlist:
             errstr = "Unexpected length!"
@@ -181,6 +310,87 @@ def test_one_of_times(times, numlist=100):
                     break
             yield (success, errstr, elapsed)
 
+def test_one_of_file_times(times, numlist=100):
+    for _ in range(times):
+        sources = generate_random_string_list(r, ascii_letters + digits)
+        cache = os.environ.get("RANDATA_CACHE")
+        with tempfile.TemporaryDirectory() as d:
+            # the index of the file goes along with it, instead
+            # of piling up in the cache of the user
+            os.environ["RANDATA_CACHE"] = d
+            path = os.path.join(d, "lines.txt")
+            with open(path, "w") as f:
+                f.write("\n".join(sources))
+            elapsed = time.perf_counter()
+            res = one_of_file_times([path], (numlist, r))[0]
+            elapsed = time.perf_counter() - elapsed
+            if cache == None:
+                del os.environ["RANDATA_CACHE"]
+            else:
+                os.environ["RANDATA_CACHE"] = cache
+        if len(res) != numlist:
+            errstr = "Unexpected length!"
+            yield (False, errstr)
+        else:
+            success = True
+            errstr = ''
+            for x in res:
+                if x not in sources:
+                    errstr = "'%s' is not in the file!" % x
+                    success = False
+                    break
+            yield (success, errstr, elapsed)
+
+def test_foreign_key_columns(times, numlist=100):
+    for j in range(times):
+        # alternate between integer and text keys
+        if j % 2 == 0:
+            sources = [r.randint(0, 1 << 62) for _ in range(numlist)]
+        else:
+            sources = generate_random_string_list(r, finalset, numwords=numlist)
+        with tempfile.TemporaryDirectory() as d:
+            keys = KeyColumn(os.path.join(d, "test.keys"))
+            keys.extend(sources[:numlist // 2])
+            keys.extend(sources[numlist // 2:])
+            elapsed = time.perf_counter()
+            res = foreign_key_columns([], (numlist, r), (keys.reference(), "test"))[0]
+            elapsed = time.perf_counter() - elapsed
+        if len(res) != numlist:
+            errstr = "Unexpected length!"
+            yield (False, errstr)
+        else:
+            success = True
+            errstr = ''
+            for x in res:
+                if x not in sources:
+                    errstr = "'%s' is not one of the keys!" % x
+                    success = False
+                    break
+            yield (success, errstr, elapsed)
+
+def test_one_of_weighted_times(times, numlist=100):
+    for _ in range(times):
+        sources = generate_random_string_list(r, finalset, numwords=10)
+        weights = [random.randint(0, 5) for _ in sources]
+        weights[0] = 1
+        pairs = [z for pair in zip(sources, weights) for z in pair]
+        elapsed = time.perf_counter()
+        res = one_of_weighted_times(pairs, (numlist, r))[0]
+        elapsed = time.perf_counter() - elapsed
+        allowed = set(s for s, w in zip(sources, weights) if w > 0)
+        if len(res) != numlist:
+            errstr = "Unexpected length!"
+            yield (False, errstr)
+        else:
+            success = True
+            errstr = ''
+            for x in res:
+                if x not in allowed:
+                    errstr = "'%s' has no weight!" % x
+                    success = False
+                    break
+            yield (success, errstr, elapsed)
+
 def test_one_of_unique(times, numlist=100):
     init_child({}, nullcontext())
     for j in range(times):
@@ -191,7 +401,7 @@ def test_one_of_unique(times, numlist=100):
         res = []
         elapsed = time.perf_counter()
         for _ in range(maxitems):
-            res.append(one_of_unique(sources, r, namelist)[0])
+            res.append(list(one_of_unique(sources, r, namelist)[0]))
         elapsed = time.perf_counter() - elapsed
         if len(res) != maxitems:
             errstr = "Unexpected length!"
@@ -238,7 +448,7 @@ def test_upto(times, numlist=100):
     for _ in range(times):
         uptolist = [random.randint(100, 500) for _ in range(numlist)]
         elapsed = time.perf_counter()
-        res = upto(uptolist, r)[0]
+        res = list(upto(zip(uptolist), r)[0])
         elapsed = time.perf_counter() - elapsed
         if len(res) != numlist:
             errstr = "Unexpected length!"
@@ -254,6 +464,27 @@ def test_upto(times, numlist=100):
                     break
             yield (success, errstr, elapsed)
 
+def test_upto_negative(times, numlist=100):
+    # negative bounds draw from [bound, 0], on both paths
+    for j in range(times):
+        count = max(numlist, NUMPY_MIN_ROWS) if j % 2 else min(numlist, NUMPY_MIN_ROWS - 1)
+        uptolist = [random.randint(-500, 500) for _ in range(count)]
+        elapsed = time.perf_counter()
+        res = list(upto(zip(uptolist), r)[0])
+        elapsed = time.perf_counter() - elapsed
+        if len(res) != count:
+            errstr = "Unexpected length!"
+            yield (False, errstr)
+        else:
+            success = True
+            errstr = ''
+            for x in zip(res, uptolist):
+                if x[0] not in range(min(x[1], 0), max(x[1], 0) + 1):
+                    errstr = '%d is not in range upto %d' % (x[0], x[1])
+                    success = False
+                    break
+            yield (success, errstr, elapsed)
+
 def test_upto_times(times, numlist=100):
     for _ in range(times):
         upt = [random.randint(100, 500)]
@@ -277,7 +508,7 @@ def test_lower(times, numlist=100):
     for _ in range(times):
         strlist = zip(generate_random_string_list(r, finalset, numwords=numlist))
         elapsed = time.perf_counter()
-        res = lower(strlist, r)[0]
+        res = list(lower(strlist, r)[0])
         elapsed = time.perf_counter() - elapsed
         if len(res) != numlist:
             yield (False, "Unexpected length!")
@@ -333,10 +564,19 @@ def store_current_result(old, new, numlists):
 
 def test_all(total=100, numlists=100):
     tests = {"append": test_append, "append_times": test_append_times,
+             "append_columns": test_append_columns,
+             "sequence_columns": test_sequence_columns,
              "between": test_between, "between_times": test_between_times,
+             "between_reversed": test_between_reversed,
+             "number_between_unique_columns": test_number_between_unique_columns,
+             "number_between_unique_widest": test_number_between_unique_widest,
              "one_of": test_one_of, "one_of_times": test_one_of_times,
+             "one_of_file_times": test_one_of_file_times,
+             "foreign_key_columns": test_foreign_key_columns,
+             "one_of_weighted_times": test_one_of_weighted_times,
              "one_of_unique": test_one_of_unique, "one_of_unique_times": test_one_of_unique_times,
              "upto": test_upto, "upto_times": test_upto_times,
+             "upto_negative": test_upto_negative,
              "lower": test_lower, "lower_times": test_lower_times}
     comparison = load_previous_result()
     oldres = {}